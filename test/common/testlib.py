@@ -24,7 +24,11 @@ Tools for writing Cockpit test cases.
 from time import sleep
 
 import argparse
+import atexit
+import collections
 import errno
+import fcntl
+import hashlib
 import subprocess
 import os
 import select
@@ -71,6 +75,7 @@ opts.revision = None
 opts.address = None
 opts.jobs = 1
 opts.network = True
+opts.workers = False
 
 def attach(filename):
     if not opts.attachments:
@@ -91,6 +96,7 @@ class Browser:
     def title(self):
         return self.phantom.eval('document.title')
 
+    @testvm.timed("browser.open")
     def open(self, href, cookie=None):
         """
         Load a page into the browser.
@@ -200,6 +206,7 @@ class Browser:
         self.phantom.timeout = max(timeout, self.phantom.timeout)
         return r
 
+    @testvm.timed("browser.wait")
     def wait(self, predicate):
         self.arm_timeout()
         while True:
@@ -306,6 +313,7 @@ class Browser:
         self.click(sel + " " + button)
         self.wait_not_visible(sel)
 
+    @testvm.timed("browser.enter_page")
     def enter_page(self, path, host=None, reconnect=True):
         """Wait for a page to become current.
 
@@ -356,6 +364,7 @@ class Browser:
         else:
             self.click(sel + ' button:first-child');
 
+    @testvm.timed("browser.login_and_go")
     def login_and_go(self, path=None, user=None, host=None, authorized=True):
         if user is None:
             user = self.default_user
@@ -405,6 +414,7 @@ class Browser:
                 host = None
             self.enter_page(path.split("#")[0], host=host)
 
+    @testvm.timed("browser.snapshot")
     def snapshot(self, title, label=None):
         """Take a snapshot of the current screen and save it as a PNG.
 
@@ -416,10 +426,41 @@ class Browser:
             self.phantom.show(filename)
             attach(filename)
 
+    @testvm.timed("browser.kill")
     def kill(self):
         self.phantom.kill()
 
 
+_machine_pool = None
+
+def machine_pool():
+    """Return the testvm.MachinePool of this process, if TEST_POOL asks for one
+
+    Spare machines only pay off in processes that run one test after the
+    other, so there is no pool unless tests run in workers, see TestWorkers.
+    """
+    global _machine_pool
+    spec = os.environ.get("TEST_POOL")
+    if not spec or not opts.workers:
+        return None
+    # Machines of a pool belong to the process that started them
+    if not _machine_pool or _machine_pool[0] != os.getpid():
+        (sizes, default_size) = testvm.MachinePool.parse_sizes(spec)
+        memory_mb = os.environ.get("TEST_POOL_MEMORY")
+        pool = testvm.MachinePool(sizes, default_size, memory_mb=memory_mb and int(memory_mb),
+                                  verbose=opts.trace, fetch=opts.network)
+        pid = os.getpid()
+        def close():
+            # Forked children inherit this, but not the machines
+            if os.getpid() != pid:
+                return
+            pool.close()
+            if pool.leases:
+                sys.stderr.write("# {0}\n".format(pool.report()))
+        atexit.register(close)
+        _machine_pool = (pid, pool)
+    return _machine_pool[1]
+
 class MachineCase(unittest.TestCase):
     runner = None
     machine = None
@@ -427,6 +468,12 @@ class MachineCase(unittest.TestCase):
     browser = None
     machines = { }
 
+    # Seconds that setUp() waited for machines to boot or to come from a pool or snapshot
+    boot_time = None
+
+    # Start the main machine from a snapshot of its image, see VirtMachine.restore_snapshot()
+    use_snapshot = os.environ.get("TEST_SNAPSHOT", "") not in ("", "0")
+
     # additional_machines is a dictionary of dictionaries, one for each additional machine to be created, e.g.:
     # additional_machines = { 'openshift' : { machine: { 'image': 'openshift' }, 'start': { 'memory_mb': 1024 } } }
     # These will be instantiated during setUp
@@ -455,6 +502,19 @@ class MachineCase(unittest.TestCase):
         self.machines[machine_key] = machine
         return machine
 
+    def lease_machine(self, machine_key, image=testvm.DEFAULT_IMAGE):
+        """Lease a booted machine from the machine pool, if there is one
+
+        Returns None when machines have to be started by the test itself.
+        """
+        pool = machine_pool()
+        if not pool or self.machine_class or opts.address or not pool.size(image):
+            return None
+        machine = pool.lease(image, label=self.label())
+        self.addCleanup(lambda: pool.release(machine))
+        self.machines[machine_key] = machine
+        return machine
+
     def new_browser(self, address=None, port=9090):
         browser = Browser(address = address or self.machine.address, label=self.label(), port=port)
         self.addCleanup(lambda: browser.kill())
@@ -472,6 +532,12 @@ class MachineCase(unittest.TestCase):
 
         self.currentResult = result
 
+        # Time the phases of the test, see testvm.PhaseTimers
+        phases = [ ("setUp", "setUp"), ("test", self._testMethodName),
+                   ("tearDown", "tearDown"), ("cleanup", "doCleanups") ]
+        for (phase, name) in phases:
+            setattr(self, name, testvm.timed(phase)(getattr(self, name)))
+
         # Here's the loop to actually retry running the test. It's an awkward
         # place for this loop, since it only applies to MachineCase based
         # TestCases. However for the time being there is no better place for it.
@@ -480,6 +546,7 @@ class MachineCase(unittest.TestCase):
         # prevent endless retries if Policy.check_retry is buggy.
         max_retry_hard_limit = 10
         for retry in range(0, max_retry_hard_limit):
+            self.boot_time = None
             try:
                 super(MachineCase, self).run(result)
             except RetryError, ex:
@@ -489,6 +556,8 @@ class MachineCase(unittest.TestCase):
             else:
                 break
 
+        for (phase, name) in phases:
+            delattr(self, name)
         self.currentResult = None
 
         # Standard book keeping that we have to do
@@ -499,9 +568,23 @@ class MachineCase(unittest.TestCase):
 
     def setUp(self, macaddr=None, memory_mb=None, cpus=None):
         self.machines = { }
-        self.machine = self.new_machine(machine_key='0')
-
-        self.machine.start(macaddr=macaddr, memory_mb=memory_mb, cpus=cpus, wait_for_ip=False)
+        leased = set()
+        boot_start = time.time()
+        save_snapshot = False
+
+        # Only machines started with default options come from the pool or a snapshot
+        defaults = not macaddr and not memory_mb and not cpus
+        self.machine = None
+        if defaults:
+            self.machine = self.lease_machine(machine_key='0')
+        if self.machine:
+            leased.add('0')
+        else:
+            self.machine = self.new_machine(machine_key='0')
+            snapshot = defaults and self.use_snapshot and not self.machine_class and not opts.address
+            if not snapshot or not self.machine.restore_snapshot():
+                self.machine.start(macaddr=macaddr, memory_mb=memory_mb, cpus=cpus, wait_for_ip=False)
+                save_snapshot = snapshot and not self.machine.has_snapshot()
 
         # first create all additional machines, wait for them later
         for machine_name, machine_options in self.additional_machines.iteritems():
@@ -509,18 +592,29 @@ class MachineCase(unittest.TestCase):
                 machine_options['machine'] = { }
             if not 'start' in machine_options:
                 machine_options['start'] = { }
-            machine = self.new_machine(machine_key=machine_name, **machine_options['machine'])
             options = machine_options['start']
+            if set(options) <= set(['wait_for_ip']) and set(machine_options['machine']) <= set(['image']):
+                if self.lease_machine(machine_key=machine_name, **machine_options['machine']):
+                    leased.add(machine_name)
+                    continue
+            machine = self.new_machine(machine_key=machine_name, **machine_options['machine'])
             options['wait_for_ip'] = False
             machine.start(**options)
 
-        # now wait for the other machines to be up
+        # now wait for the other machines to be up, leased ones already are
         for machine_name, machine in self.machines.iteritems():
+            if machine_name in leased:
+                continue
             if machine_name != '0' or not opts.address:
                 if opts.trace:
                     print "starting machine %s (%s)" % (machine.image, machine.address)
                 machine.wait_boot()
 
+        # Later tests continue from here instead of booting
+        if save_snapshot and self.machine.save_snapshot():
+            self.machine.wait_boot()
+        self.boot_time = time.time() - boot_start
+
         self.browser = self.new_browser()
         self.tmpdir = tempfile.mkdtemp()
 
@@ -544,6 +638,7 @@ class MachineCase(unittest.TestCase):
             self.check_journal_messages()
         shutil.rmtree(self.tmpdir)
 
+    @testvm.timed("login_and_go")
     def login_and_go(self, path=None, user=None, host=None, authorized=True):
         self.machine.start_cockpit(host)
         self.browser.login_and_go(path, user=user, host=host, authorized=authorized)
@@ -678,33 +773,31 @@ class MachineCase(unittest.TestCase):
                                     ".*Sorry, try again.",
                                     ".*incorrect password attempt.*")
 
+    @testvm.timed("check_journal_messages")
     def check_journal_messages(self, machine=None):
         """Check for unexpected journal entries."""
         machine = machine or self.machine
-        syslog_ids = [ "cockpit-ws", "cockpit-bridge" ]
-        messages = machine.journal_messages(syslog_ids, 5)
-        messages += machine.audit_messages("14") # 14xx is selinux
-        all_found = True
-        first = None
-        for m in messages:
+
+        def allowed(m):
             # remove leading/trailing whitespace
             m = m.strip()
-            found = False
             for p in self.allowed_messages:
                 match = re.match(p, m)
                 if match and match.group(0) == m:
-                    found = True
-                    break
-            if not found:
-                print "Unexpected journal message '%s'" % m
-                all_found = False
-                if not first:
-                    first = m
-        if not all_found:
+                    return True
+            return False
+
+        syslog_ids = [ "cockpit-ws", "cockpit-bridge" ]
+        messages = machine.journal_messages(syslog_ids, 5, ignore=allowed)
+        messages += machine.audit_messages("14", ignore=allowed) # 14xx is selinux
+        for m in messages:
+            print "Unexpected journal message '%s'" % m.strip()
+        if messages:
             self.copy_journal("FAIL")
             self.copy_cores("FAIL")
-            raise Error(first)
+            raise Error(messages[0].strip())
 
+    @testvm.timed("snapshot")
     def snapshot(self, title, label=None):
         """Take a snapshot of the current screen and save it as a PNG.
 
@@ -714,20 +807,27 @@ class MachineCase(unittest.TestCase):
         if self.browser is not None:
             self.browser.snapshot(title, label)
 
+    @testvm.timed("copy_journal")
     def copy_journal(self, title, label=None):
         for name, m in self.machines.iteritems():
             if m.address:
                 log = "%s-%s-%s.log" % (label or self.label(), m.address, title)
                 with open(log, "w") as fp:
-                    m.execute("journalctl", stdout=fp)
+                    try:
+                        for data in m.execute_stream("journalctl", lines=False):
+                            fp.write(data)
+                    except subprocess.CalledProcessError, ex:
+                        print "Journal extraction failed with code %d" % (ex.returncode)
                     print "Journal extracted to %s" % (log)
                     attach(log)
 
+    @testvm.timed("copy_cores")
     def copy_cores(self, title, label=None):
         for name, m in self.machines.iteritems():
             if m.address:
                 dest = "%s-%s-%s.core" % (label or self.label(), m.address, title)
-                m.download_dir("/var/lib/systemd/coredump", dest)
+                # Don't let huge core dumps dominate the time of a failed test
+                m.download_dir("/var/lib/systemd/coredump", dest, max_size=200 * 1024 * 1024)
                 try:
                     os.rmdir(dest)
                 except OSError, ex:
@@ -873,8 +973,10 @@ class Policy(object):
         return False
 
 class TestResult(tap.TapResult):
-    def __init__(self, stream, descriptions, verbosity):
+    def __init__(self, stream, descriptions, verbosity, records=None):
         self.policy = None
+        self.records = records
+        self.record = None
         super(TestResult, self).__init__(verbosity)
 
     def maybeIgnore(self, test, err):
@@ -882,16 +984,35 @@ class TestResult(tap.TapResult):
         if self.policy:
             issue = self.policy.check_issue(string)
             if issue:
+                if self.record:
+                    self.record["issue"] = int(issue)
                 self.addSkip(test, "Known issue #{0}".format(issue))
                 return True
             tries = getattr(test, "retryCount", 1)
             if self.policy.check_retry(string, tries):
+                if self.record:
+                    self.record["status"] = "retry"
                 self.offset -= 1
                 setattr(test, "retryCount", tries + 1)
                 test.doCleanups()
                 raise RetryError("Retrying due to failure of test harness or framework")
         return False
 
+    def _is_relevant_tb_level(self, tb):
+        # Tracebacks start at the test method, not at the timer around it, see MachineCase.run()
+        code = tb.tb_frame.f_code
+        if code.co_name == "timed_phase" and code.co_filename == testvm.timed.__code__.co_filename:
+            return True
+        return super(TestResult, self)._is_relevant_tb_level(tb)
+
+    def _count_relevant_tb_levels(self, tb):
+        # Only the leading timers are skipped, the timed helpers that failed stay in the traceback
+        length = 0
+        while tb and not super(TestResult, self)._is_relevant_tb_level(tb):
+            length += 1
+            tb = tb.tb_next
+        return length
+
     def addError(self, test, err):
         if not self.maybeIgnore(test, err):
             super(TestResult, self).addError(test, err)
@@ -900,15 +1021,91 @@ class TestResult(tap.TapResult):
         if not self.maybeIgnore(test, err):
             super(TestResult, self).addError(test, err)
 
+    def addSuccess(self, test):
+        if self.record:
+            self.record["status"] = "ok"
+        super(TestResult, self).addSuccess(test)
+
+    def addSkip(self, test, reason):
+        if self.record:
+            self.record["status"] = "skip"
+            self.record["skip"] = reason
+        super(TestResult, self).addSkip(test, reason)
+
+    def addExpectedFailure(self, test, err):
+        if self.record:
+            self.record["status"] = "ok"
+        super(TestResult, self).addExpectedFailure(test, err)
+
     def startTest(self, test):
         sys.stdout.write("# {0}\n# {1}\n#\n".format('-' * 70, str(test)))
         sys.stdout.flush()
         super(TestResult, self).startTest(test)
+        testvm.timers.reset()
+        if self.records:
+            self.record = { "number": self.offset, "test": test.id().replace("__main__.", ""),
+                            "start": int(self.start_time * 1000), "status": "not ok",
+                            "retries": getattr(test, "retryCount", 1) - 1 }
 
     def stopTest(self, test):
+        phases = [(p, s) for (p, (c, s)) in sorted(testvm.timers.results().items()) if "/" not in p]
+        if phases:
+            sys.stdout.write("# Phases: {0}\n".format(", ".join("{0} {1:.1f}s".format(p, s) for (p, s) in phases)))
         sys.stdout.write("\n")
         sys.stdout.flush()
         super(TestResult, self).stopTest(test)
+        if self.record and self.record["status"] != "retry":
+            self.record["end"] = int(time.time() * 1000)
+            boot_time = getattr(test, "boot_time", None)
+            if boot_time is not None:
+                self.record["boot"] = round(boot_time, 3)
+            timers = testvm.timers.results()
+            if timers:
+                self.record["phases"] = dict((p, s) for (p, (c, s)) in timers.items() if "/" not in p)
+                self.record["timers"] = timers
+            self.records.write(self.record)
+        self.record = None
+
+class ResultRecords(object):
+    """ A file with one JSON record for each test that ran
+
+        Each test process appends the record of a test when it is done,
+        so the file can be followed while tests run in parallel. A record
+        has the "test" id and the TAP "number", the "status" ("ok", "not
+        ok" or "skip"), "start" and "end" in milliseconds since the epoch,
+        the number of "retries", the seconds of "boot" and of the
+        "phases" of a MachineCase, the "timers" of the phases and of
+        what they did as { path: [ count, seconds ] }, see
+        testvm.PhaseTimers, and the "skip" reason or known "issue".
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def read(self, offset=0):
+        """Return the records after offset in the file"""
+        records = [ ]
+        with open(self.path, "r") as fp:
+            fp.seek(offset)
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+        return records
+
+    def write(self, record):
+        self.append(json.dumps(record, sort_keys=True) + "\n")
+
+    def append(self, lines):
+        with open(self.path, "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.write(lines)
 
 class OutputBuffer(object):
     def __init__(self):
@@ -947,17 +1144,191 @@ class OutputBuffer(object):
         os.close(fd)
         return buffer
 
+# Memory in MiB that the host keeps for itself when running tests in parallel
+HOST_RESERVE_MB = 2048
+
+# Test machines spend most of their time waiting, so they can share CPUs
+HOST_CPU_OVERCOMMIT = 2
+
+def host_capacity():
+    """Return the memory in MiB and number of CPUs that test machines can use
+
+    At least one test machine always fits, even on a host that is smaller
+    than HOST_RESERVE_MB.
+    """
+    memory_mb = None
+    with open("/proc/meminfo", "r") as fp:
+        for line in fp:
+            if line.startswith("MemTotal:"):
+                total_mb = int(line.split()[1]) // 1024
+                memory_mb = total_mb - HOST_RESERVE_MB
+                if memory_mb < testvm.MEMORY_MB:
+                    sys.stderr.write("WARNING: This host has only {0} MiB of memory, with {1} MiB reserved for it, "
+                                     "tests only run one at a time\n".format(total_mb, HOST_RESERVE_MB))
+                    memory_mb = testvm.MEMORY_MB
+    return (memory_mb, os.sysconf("SC_NPROCESSORS_ONLN") * HOST_CPU_OVERCOMMIT)
+
+def test_footprint(test):
+    """Return the memory in MiB and number of CPUs of the machines that test starts
+
+    This goes by what MachineCase classes declare, tests in a suite run one
+    after the other, so the biggest one counts.
+    """
+    if isinstance(test, unittest.TestSuite):
+        footprints = [test_footprint(t) for t in test]
+        return (max([m for (m, c) in footprints] or [0]), max([c for (m, c) in footprints] or [0]))
+    if not isinstance(test, MachineCase) or opts.address:
+        return (0, 0)
+    machine_class = test.machine_class or testvm.VirtMachine
+    memory_mb = machine_class.memory_mb or testvm.MEMORY_MB
+    cpus = machine_class.cpus or 1
+    for options in test.additional_machines.values():
+        start = options.get("start", { })
+        memory_mb += start.get("memory_mb") or testvm.VirtMachine.memory_mb or testvm.MEMORY_MB
+        cpus += start.get("cpus") or testvm.VirtMachine.cpus or 1
+    return (memory_mb, cpus)
+
+def test_cases(test):
+    """Return the test cases in test, which may be a suite of suites"""
+    if isinstance(test, unittest.TestSuite):
+        return [case for t in test for case in test_cases(t)]
+    return [ test ]
+
+class DurationHistory(object):
+    """ How long tests took in earlier runs on this host
+
+        The history is kept in TEST_DATA/tmp/test-durations.json, by the
+        name of the test program and the ids of the tests that ran in one
+        process. New durations are averaged with the old ones, and merged
+        into what other test runs saved in the meantime.
+    """
+    def __init__(self, path=None):
+        if not path:
+            base_dir = os.path.join(os.path.dirname(__file__), "..", "..")
+            path = os.path.join(os.environ.get("TEST_DATA", base_dir), "tmp", "test-durations.json")
+        self.path = path
+        self.durations = self._load()
+        self.recorded = { }
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return { }
+
+    @staticmethod
+    def key(test):
+        ids = [t.id().replace("__main__.", "") for t in test_cases(test)]
+        classes = set(i.rpartition(".")[0] for i in ids)
+        if len(ids) > 1 and len(classes) == 1:
+            ids = [classes.pop() + ".*"]
+        return "{0}:{1}".format(os.path.basename(sys.argv[0]), ",".join(ids))
+
+    def expected(self, key):
+        return self.durations.get(key)
+
+    def record(self, key, seconds):
+        self.recorded[key] = seconds
+
+    def save(self):
+        if not self.recorded:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            durations = self._load()
+            for (key, seconds) in self.recorded.items():
+                previous = durations.get(key)
+                durations[key] = seconds if previous is None else (previous + seconds) / 2.0
+            with open(self.path + ".tmp", "w") as fp:
+                json.dump(durations, fp, indent=1, sort_keys=True)
+            os.rename(self.path + ".tmp", self.path)
+        self.durations = durations
+        self.recorded = { }
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+def report_timers(records):
+    """Write how long the phases took over all tests in records
+
+    The percentiles are of the time that one test spent in a phase.
+    """
+    times = { }
+    for record in records:
+        for (path, (count, seconds)) in record.get("timers", { }).items():
+            entry = times.setdefault(path, [ 0, [ ] ])
+            entry[0] += count
+            entry[1].append(seconds)
+    if not times:
+        return
+    sys.stdout.write("# {0:<48} {1:>6} {2:>7} {3:>9} {4:>8} {5:>8}\n".format("Phase", "tests", "count", "total", "p50", "p95"))
+    for path in sorted(times, key=lambda p: p.split("/")):
+        (count, seconds) = times[path]
+        parts = path.split("/")
+        name = "  " * (len(parts) - 1) + parts[-1]
+        sys.stdout.write("# {0:<48} {1:>6} {2:>7} {3:>8.1f}s {4:>7.1f}s {5:>7.1f}s\n".format(
+            name, len(seconds), count, sum(seconds), percentile(seconds, 50), percentile(seconds, 95)))
+
+def predict_makespan(durations, jobs):
+    """Predict how long durations take when run longest first on jobs slots"""
+    slots = [ 0 ] * max(jobs, 1)
+    for duration in sorted(durations, reverse=True):
+        slots[slots.index(min(slots))] += duration
+    return max(slots)
+
+# How long the coordinator of a distributed run waits for a worker to take a message
+COORDINATOR_SEND_TIMEOUT = 30
+
+# The longest message in bytes that the coordinator takes from a worker, before
+# and after it said hello, test output and records can be long
+COORDINATOR_MAX_HELLO = 4096
+COORDINATOR_MAX_MESSAGE = 256 * 1024 * 1024
+
+# How often the coordinator says that it's waiting, while no worker runs a test
+COORDINATOR_WAIT_MESSAGE_INTERVAL = 60
+
 class TapRunner(object):
     resultclass = TestResult
 
-    def __init__(self, verbosity=1, jobs=1, thorough=False):
+    def __init__(self, verbosity=1, jobs=1, thorough=False, workers=False, listen=None, connect=None,
+                 results=None):
         self.stream = unittest.runner._WritelnDecorator(sys.stderr)
+        self.results = results and ResultRecords(results) or None
         self.verbosity = verbosity
         self.thorough = thorough
         self.jobs = jobs
+        self.workers = workers
+        self.listen = listen
+        self.connect = connect
+
+    def schedule(self, pending, free, idle):
+        """Pick the index of the next test in pending to run, or None to wait
+
+        Tests run in order as long as their footprint fits into the free
+        resources, smaller ones can be started while the first one waits
+        for resources, but only self.jobs times, so it doesn't wait forever.
+        A test that is too big for the host runs when nothing else does.
+        """
+        for (index, (position, test, offset, footprint)) in enumerate(pending):
+            if all(need <= have for (need, have) in zip(footprint, free)):
+                if index > 0:
+                    self.passed_over += 1
+                return index
+            if index == 0 and idle:
+                return index
+            if index == 0 and self.passed_over >= self.jobs:
+                return None
+        return None
 
     def runOne(self, test, offset):
-        result = TestResult(self.stream, False, self.verbosity)
+        result = TestResult(self.stream, False, self.verbosity, records=self.results)
         result.offset = offset
         if not self.thorough:
             result.policy = Policy()
@@ -974,79 +1345,563 @@ class TapRunner(object):
             return result.wasSuccessful()
 
     def run(self, testable):
+        tests = [ ]
+        offset = 0
+        for test in testable:
+            tests.append((test, offset))
+            offset += test.countTestCases()
+
+        # A worker of a distributed run, the coordinator writes the plan
+        if self.connect:
+            return self.work_for(tests, self.connect)
+
         tap.TapResult.plan(testable)
-        count = testable.countTestCases()
 
         # For statistics
         start = time.time()
 
-        pids = set()
-        options = 0
-        buffer = None
-        if self.jobs > 1:
-            buffer = OutputBuffer()
-            options = os.WNOHANG
-        offset = 0
+        # The phase timers of the tests come back in their records
+        records = self.results
+        if not records:
+            (fd, path) = tempfile.mkstemp(prefix="test-results-")
+            os.close(fd)
+            self.results = ResultRecords(path)
+        records_offset = self.results.size()
+        pid = os.getpid()
+
+        history = DurationHistory()
+        pending = [(position, test, offset, test_footprint(test)) for (position, (test, offset)) in enumerate(tests)]
+
+        # Start the longest tests first, so that no job waits for one at the end
+        predicted = None
+        if self.jobs > 1 or self.listen:
+            known = [history.expected(history.key(test)) for (position, test, offset, footprint) in pending]
+            known = [d for d in known if d is not None]
+            if known:
+                default = sum(known) / len(known)
+                expected = lambda item: history.expected(history.key(item[1])) or default
+                pending.sort(key=expected, reverse=True)
+                if not self.listen:
+                    predicted = predict_makespan([expected(item) for item in pending], self.jobs)
+
+        try:
+            if self.listen:
+                count = self.coordinate(tests, [item[0] for item in pending], history)
+            else:
+                count = self.run_local(pending, tests, history)
+        except KeyboardInterrupt:
+            if not records and os.getpid() == pid:
+                os.unlink(self.results.path)
+            sys.exit(255)
+        history.save()
+        report_timers(self.results.read(records_offset))
+        if not records:
+            os.unlink(self.results.path)
+            self.results = None
+
+        # Report on the results
+        duration = int(time.time() - start)
+        if predicted is not None:
+            sys.stdout.write("# Predicted duration: {0}s, actual: {1}s\n".format(int(predicted), duration))
+        hostname = socket.gethostname().split(".")[0]
+        details = "[{0}s on {1}]".format(duration, hostname)
+        if count:
+            sys.stdout.write("# {0} TESTS FAILED {1}\n".format(count, details))
+        else:
+            sys.stdout.write("# TESTS PASSED {0}\n".format(details))
+        return count
+
+    def run_local(self, pending, tests, history):
+        """Run the pending tests on this host and return how many failed"""
         failures = { "count": 0 }
 
-        def join_some(n):
-            while len(pids) > n:
-                if buffer:
-                    buffer.drain()
-                try:
-                    (pid, code) = os.waitpid(-1, options)
-                except KeyboardInterrupt:
-                    sys.exit(255)
-                if pid:
-                    if buffer:
-                        sys.stdout.write(buffer.pop(pid))
-                    pids.remove(pid)
-                if code & 0xff:
-                    failed = 1
-                else:
-                    failed = (code >> 8) & 0xff
-                failures["count"] += failed
+        # The machines of all running tests have to fit into the host
+        (memory_mb, cpus) = host_capacity()
+        free = [ memory_mb, cpus ]
+        self.passed_over = 0
 
-        for test in testable:
-            join_some(self.jobs - 1)
+        if self.workers:
+            jobs = TestWorkers(self, tests, capture=self.jobs > 1)
+        else:
+            jobs = TestProcesses(self, capture=self.jobs > 1)
+
+        # position -> (footprint, history key, start time) of running tests
+        running = { }
+
+        def reap(block):
+            for (position, failed) in jobs.reap(block):
+                (footprint, key, started_at) = running.pop(position)
+                for (i, need) in enumerate(footprint):
+                    free[i] += need
+                history.record(key, time.time() - started_at)
+                failures["count"] += failed
 
-            # Fork off a child process for each test
-            if buffer:
-                (rfd, wfd) = os.pipe()
+        try:
+            while pending:
+                while len(running) >= self.jobs:
+                    reap(True)
+                index = self.schedule(pending, free, idle=not running)
+                if index is None:
+                    # Wait for a test to finish and free its resources
+                    reap(True)
+                    continue
+                (position, test, offset, footprint) = pending.pop(index)
+                if index == 0:
+                    self.passed_over = 0
+
+                jobs.start(position, test, offset)
+                running[position] = (footprint, history.key(test), time.time())
+                for (i, need) in enumerate(footprint):
+                    free[i] -= need
+
+            # Wait for the remaining tests
+            while running:
+                reap(True)
+        finally:
+            jobs.close()
+        return failures["count"]
+
+    def coordinate(self, tests, order, history):
+        """Hand out tests to the workers that connect to self.listen
+
+        The tests run in the given order of positions, and -j local
+        workers are started as well. The output of each test is written
+        when it is done, its TAP lines are numbered by the offset that
+        the coordinator sends along. Returns how many tests failed.
+        """
+        ids = [DurationHistory.key(test) for (test, offset) in tests]
+        digest = suite_digest(ids)
+        shards = WorkDeques(order)
+        slots = self.start_slots(tests, self.listen, self.jobs, "local")
+
+        (family, address) = parse_address(self.listen)
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.unlink(address)
+        listener.bind(address)
+        listener.listen(16)
+
+        # socket -> { host, position, buffer } of connected workers
+        conns = { }
+        lost = collections.Counter()
+        remaining = set(range(len(tests)))
+        failures = 0
+
+        def assign(conn):
+            """Hand out the next test to conn, returns how many tests failed"""
+            position = shards.take(conn["host"])
+            conn["position"] = position
+            if position is not None:
+                request = { "position": position, "id": ids[position], "offset": tests[position][1] }
+                try:
+                    conn["sock"].sendall(json.dumps(request) + "\n")
+                except socket.error, ex:
+                    # Includes the send timeout of a worker that doesn't read
+                    sys.stdout.write("# Dropping worker {0}: {1}\n".format(conn["host"], ex))
+                    return drop(conn)
+            return 0
+
+        def drop(conn):
+            if conns.pop(conn["sock"], None) is None:
+                return 0
+            conn["sock"].close()
+            position = conn["position"]
+            if position is None:
+                return 0
+            # Give the test to another worker, unless it already took down one before
+            lost[position] += 1
+            if lost[position] < 2:
+                sys.stdout.write("# Worker on {0} went away, running {1} again\n".format(conn["host"], ids[position]))
+                shards.give_back(position)
+                for other in conns.values():
+                    if other["host"] and other["position"] is None:
+                        return assign(other)
+                return 0
+            remaining.discard(position)
+            (test, offset) = tests[position]
+            for (i, case) in enumerate(test_cases(test)):
+                sys.stdout.write("not ok {0} {1} # worker on {2} went away\n".format(offset + i + 1, case, conn["host"]))
+                if self.results:
+                    self.results.write({ "number": offset + i + 1, "test": case.id().replace("__main__.", ""),
+                                         "status": "not ok", "lost": conn["host"] })
+            return 1
+
+        def handle(conn, message):
+            """Act on one message from a worker, returns how many tests failed
+
+            Raises ValueError, KeyError or TypeError for anything a worker
+            would not send.
+            """
+            failed = 0
+            if not conn["host"]:
+                if message["suite"] != digest:
+                    conn["sock"].sendall(json.dumps({ "error": "the worker loaded different tests" }) + "\n")
+                    return drop(conn)
+                conn["host"] = unicode(message["hello"])
+            elif conn["position"] is not None and message["position"] == conn["position"]:
+                # Check all of the result before any of it counts
+                position = conn["position"]
+                output = unicode(message["output"]).encode("utf-8")
+                records = unicode(message.get("records") or "").encode("utf-8")
+                duration = float(message["duration"])
+                failed = int(message["failed"])
+                sys.stdout.write(output)
+                if self.results and records:
+                    self.results.append(records)
+                history.record(ids[position], duration)
+                remaining.discard(position)
+            else:
+                raise ValueError("unexpected message")
+            return failed + assign(conn)
 
+        try:
+            while remaining:
+                (ready, unused, unused) = select.select([ listener ] + conns.keys(), [ ], [ ],
+                                                        COORDINATOR_WAIT_MESSAGE_INTERVAL)
+                if not ready and all(c["position"] is None for c in conns.values()):
+                    sys.stdout.write("# Waiting for workers at {0}, {1} tests left\n".format(self.listen, len(remaining)))
+                    sys.stdout.flush()
+                for sock in ready:
+                    if sock is listener:
+                        (conn, unused) = listener.accept()
+                        # Only sends block, recv() happens when there is data
+                        conn.settimeout(COORDINATOR_SEND_TIMEOUT)
+                        conns[conn] = { "sock": conn, "host": None, "position": None, "buffer": "" }
+                        continue
+                    conn = conns.get(sock)
+                    if not conn:
+                        continue
+                    try:
+                        data = sock.recv(65536)
+                        if not data:
+                            failures += drop(conn)
+                            continue
+                        conn["buffer"] += data
+                        while "\n" in conn["buffer"] and sock in conns:
+                            (line, unused, conn["buffer"]) = conn["buffer"].partition("\n")
+                            failures += handle(conn, json.loads(line))
+                        limit = conn["host"] and COORDINATOR_MAX_MESSAGE or COORDINATOR_MAX_HELLO
+                        if sock in conns and len(conn["buffer"]) > limit:
+                            raise ValueError("message longer than {0} bytes".format(limit))
+                    except (ValueError, KeyError, TypeError, AttributeError, socket.error), ex:
+                        # Anyone can connect, don't let them take down the run
+                        sys.stdout.write("# Dropping worker {0}: {1}\n".format(conn["host"] or "that did not say hello", ex))
+                        failures += drop(conn)
+        finally:
+            for sock in conns.keys():
+                sock.close()
+            listener.close()
+            if family == socket.AF_UNIX:
+                os.unlink(address)
+            for pid in slots:
+                os.waitpid(pid, 0)
+        return failures
+
+    def start_slots(self, tests, address, count, host):
+        """Fork count processes that run tests for the coordinator at address"""
+        pids = [ ]
+        for i in range(count):
             sys.stdout.flush()
             sys.stderr.flush()
             pid = os.fork()
             if not pid:
-                if buffer:
-                    os.dup2(wfd, 1)
-                    os.dup2(wfd, 2)
-                random.seed()
-                if self.runOne(test, offset):
-                    sys.exit(0)
-                else:
-                    sys.exit(1)
+                sys.exit(self.serve(tests, address, host))
+            pids.append(pid)
+        return pids
+
+    def work_for(self, tests, address):
+        """Run tests for the coordinator at address in -j slots until it is done"""
+        host = "{0}:{1}".format(socket.gethostname().split(".")[0], os.getpid())
+        code = 0
+        try:
+            for pid in self.start_slots(tests, address, max(self.jobs, 1), host):
+                if os.waitpid(pid, 0)[1]:
+                    code = 1
+        except KeyboardInterrupt:
+            sys.exit(255)
+        return code
+
+    def serve(self, tests, address, host):
+        """Run the tests that the coordinator at address hands out, one at a time"""
+        ids = [DurationHistory.key(test) for (test, offset) in tests]
+        sock = wait(lambda: connect_address(address), delay=0.5, tries=120)
+        sock.sendall(json.dumps({ "hello": host, "suite": suite_digest(ids) }) + "\n")
+        commands = sock.makefile("r")
+
+        if self.workers:
+            jobs = TestWorkers(self, tests, capture=True)
+        else:
+            jobs = TestProcesses(self, capture=True)
+        outputs = { }
+        jobs.emit = outputs.__setitem__
 
-            # The parent process
-            pids.add(pid)
-            if buffer:
-                os.close(wfd)
-                buffer.push(pid, rfd)
-            offset += test.countTestCases()
+        # The coordinator writes the records of the tests, if it wants them
+        (fd, path) = tempfile.mkstemp(prefix="test-results-")
+        os.close(fd)
+        self.results = ResultRecords(path)
+        pid = os.getpid()
 
-        # Wait for the remaining subprocesses
-        join_some(0)
+        try:
+            while True:
+                line = commands.readline()
+                if not line:
+                    return 0
+                request = json.loads(line)
+                if "error" in request:
+                    sys.stderr.write("# Coordinator at {0}: {1}\n".format(address, request["error"]))
+                    return 1
+                position = request["position"]
+                if ids[position] != request["id"]:
+                    sys.stderr.write("# Coordinator at {0} asked for {1}, not {2}\n".format(address, request["id"], ids[position]))
+                    return 1
+                (test, offset) = tests[position]
+                started_at = time.time()
+                jobs.start(position, test, request["offset"])
+                done = [ ]
+                while not done:
+                    done = jobs.reap(True)
+                reply = { "position": position, "failed": done[0][1], "duration": time.time() - started_at,
+                          "output": outputs.pop(position, "").decode("utf-8", "replace") }
+                with open(self.results.path, "r+") as fp:
+                    reply["records"] = fp.read().decode("utf-8", "replace")
+                    fp.truncate(0)
+                sock.sendall(json.dumps(reply) + "\n")
+        finally:
+            # Test processes are forked from here, and exit through here
+            if os.getpid() == pid:
+                jobs.close()
+                sock.close()
+                os.unlink(self.results.path)
+
+def parse_address(address):
+    """Return the socket family and address for "host:port" or the path of a unix socket
+
+    Without a host, as in ":port", the address is on localhost. IPv6
+    addresses are written in brackets, like "[::1]:port".
+    """
+    (host, sep, port) = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        if host.startswith("[") and host.endswith("]"):
+            return (socket.AF_INET6, (host[1:-1], int(port)))
+        return (socket.AF_INET, (host or "localhost", int(port)))
+    return (socket.AF_UNIX, address)
+
+def connect_address(address):
+    (family, address) = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+    except socket.error:
+        sock.close()
+        raise
+    return sock
+
+def suite_digest(ids):
+    """Identify a list of tests, the coordinator and its workers have to agree on it"""
+    return hashlib.sha1("\n".join(ids)).hexdigest()
+
+class WorkDeques(object):
+    """ The tests that each host of a distributed run is going to run
+
+        Every host takes its next test from the front of its own deque.
+        A host whose deque is empty steals from the biggest deque: the
+        back half of the deque of another host, so that hosts that are
+        done early take over work from slow ones. Tests start out in a
+        deque that belongs to no host, and hosts steal every other test
+        from it, so that each gets its share of the long ones.
+    """
+    def __init__(self, positions):
+        self.unowned = collections.deque(positions)
+        self.deques = { }
+
+    def give_back(self, position):
+        self.unowned.appendleft(position)
+
+    def take(self, host):
+        """Return the position of the next test for host, or None"""
+        own = self.deques.setdefault(host, collections.deque())
+        if not own:
+            victim = max([ self.unowned ] + self.deques.values(), key=len)
+            if victim is self.unowned:
+                positions = list(victim)
+                victim.clear()
+                victim.extend(positions[1::2])
+                own.extend(positions[0::2])
+            else:
+                for i in range(len(victim) // 2):
+                    own.appendleft(victim.pop())
+        if own:
+            return own.popleft()
+        return None
 
-        # Report on the results
-        duration = int(time.time() - start)
-        hostname = socket.gethostname().split(".")[0]
-        details = "[{0}s on {1}]".format(duration, hostname)
-        count = failures["count"]
-        if count:
-            sys.stdout.write("# {0} TESTS FAILED {1}\n".format(count, details))
+class TestProcesses(object):
+    """ Run each test in a new forked process, see TapRunner.run()
+
+        With capture, the output of each test is collected and written
+        when the test is done, so that parallel tests don't mix it.
+    """
+    def __init__(self, runner, capture=False):
+        self.runner = runner
+        self.buffer = capture and OutputBuffer() or None
+        self.pids = { }
+
+    def start(self, position, test, offset):
+        if self.buffer:
+            (rfd, wfd) = os.pipe()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if not pid:
+            if self.buffer:
+                os.dup2(wfd, 1)
+                os.dup2(wfd, 2)
+            random.seed()
+            if self.runner.runOne(test, offset):
+                sys.exit(0)
+            else:
+                sys.exit(1)
+
+        # The parent process
+        self.pids[pid] = position
+        if self.buffer:
+            os.close(wfd)
+            self.buffer.push(pid, rfd)
+
+    def emit(self, position, output):
+        sys.stdout.write(output)
+
+    def reap(self, block):
+        """Return (position, failed) of the tests that are done"""
+        if self.buffer:
+            self.buffer.drain()
+        (pid, code) = os.waitpid(-1, 0 if block and not self.buffer else os.WNOHANG)
+        if not pid:
+            return [ ]
+        position = self.pids.pop(pid)
+        if self.buffer:
+            self.emit(position, self.buffer.pop(pid))
+        if code & 0xff:
+            failed = 1
         else:
-            sys.stdout.write("# TESTS PASSED {0}\n".format(details))
-        return count
+            failed = (code >> 8) & 0xff
+        return [ (position, failed) ]
+
+    def close(self):
+        pass
+
+class TestWorkers(object):
+    """ Run tests in long lived worker processes, see TapRunner.run()
+
+        Workers are forked once and then run one test after the other, so
+        what they set up stays warm between tests: the libvirt connection
+        and event loop, and a machine pool. Each worker gets the position
+        of a test in tests and a file for its output over a pipe, and
+        replies with a JSON line. A worker that dies is replaced by a new
+        one, and its test counts as failed.
+    """
+    def __init__(self, runner, tests, capture=False):
+        self.runner = runner
+        self.tests = tests
+        self.capture = capture
+        self.idle = [ ]
+        self.busy = { }
+
+    def _spawn(self):
+        (cmd_r, cmd_w) = os.pipe()
+        (reply_r, reply_w) = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if not pid:
+            os.close(cmd_w)
+            os.close(reply_r)
+            # Don't keep other workers alive by holding their pipes
+            for worker in self.idle + self.busy.values():
+                os.close(worker["cmd"])
+                os.close(worker["reply"])
+            self.idle = [ ]
+            self.busy = { }
+            self._work(os.fdopen(cmd_r, "r", 0), os.fdopen(reply_w, "w", 0))
+            sys.exit(0)
+
+        os.close(cmd_r)
+        os.close(reply_w)
+        return { "pid": pid, "cmd": cmd_w, "reply": reply_r }
+
+    def _work(self, commands, replies):
+        random.seed()
+        while True:
+            line = commands.readline()
+            if not line:
+                return
+            request = json.loads(line)
+            (test, offset) = self.tests[request["position"]]
+            sys.stdout.flush()
+            sys.stderr.flush()
+            if request["output"]:
+                fd = os.open(request["output"], os.O_WRONLY | os.O_APPEND)
+                os.dup2(fd, 1)
+                os.dup2(fd, 2)
+                os.close(fd)
+            failed = 0 if self.runner.runOne(test, offset) else 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            replies.write(json.dumps({ "position": request["position"], "failed": failed }) + "\n")
+
+    def start(self, position, test, offset):
+        worker = self.idle and self.idle.pop() or self._spawn()
+        output = None
+        if self.capture:
+            (fd, output) = tempfile.mkstemp(prefix="test-output-")
+            os.close(fd)
+        worker.update({ "position": position, "output": output })
+        os.write(worker["cmd"], json.dumps({ "position": position, "output": output }) + "\n")
+        self.busy[worker["reply"]] = worker
+
+    def emit(self, position, output):
+        sys.stdout.write(output)
+
+    def _flush_output(self, worker):
+        if worker["output"]:
+            with open(worker["output"], "r") as fp:
+                self.emit(worker["position"], fp.read())
+            os.unlink(worker["output"])
+
+    def reap(self, block):
+        """Return (position, failed) of the tests that are done"""
+        done = [ ]
+        (ready, unused, unused) = select.select(self.busy.keys(), [], [], None if block else 0)
+        for fd in ready:
+            worker = self.busy.pop(fd)
+            line = ""
+            while not line.endswith("\n"):
+                data = os.read(fd, 1024)
+                if not data:
+                    break
+                line += data
+            self._flush_output(worker)
+            if line:
+                done.append((worker["position"], json.loads(line)["failed"]))
+                self.idle.append(worker)
+            else:
+                # The worker died in the middle of the test, the next one gets a new worker
+                sys.stderr.write("# Test worker {0} died\n".format(worker["pid"]))
+                os.close(worker["cmd"])
+                os.close(worker["reply"])
+                os.waitpid(worker["pid"], 0)
+                done.append((worker["position"], 1))
+        return done
+
+    def close(self):
+        for worker in self.idle + self.busy.values():
+            os.close(worker["cmd"])
+        for worker in self.idle + self.busy.values():
+            os.close(worker["reply"])
+            os.waitpid(worker["pid"], 0)
+        self.idle = [ ]
+        self.busy = { }
 
 def arg_parser():
     parser = argparse.ArgumentParser(description='Run Cockpit test(s)')
@@ -1064,6 +1919,15 @@ def arg_parser():
                         help="Sit and wait after test failure")
     parser.add_argument('--nonet', dest="network", action="store_false",
                         help="Don't go online to download images or data")
+    parser.add_argument('-w', '--workers', dest="workers", action="store_true",
+                        default=os.environ.get("TEST_WORKERS", "") not in ("", "0"),
+                        help="Run tests in long lived worker processes")
+    parser.add_argument('--results', dest="results", metavar="FILE", default=os.environ.get("TEST_RESULTS"),
+                        help="Append a JSON record for each test to FILE")
+    parser.add_argument('--listen', dest="listen", metavar="ADDRESS",
+                        help="Hand out tests to workers that connect to host:port or a unix socket")
+    parser.add_argument('--connect', dest="connect", metavar="ADDRESS",
+                        help="Run the tests that the coordinator at this address hands out")
     parser.add_argument('tests', nargs='*')
 
     parser.set_defaults(verbosity=1, network=True)
@@ -1097,6 +1961,15 @@ def test_main(options=None, suite=None, attachments=None, **kwargs):
 
     if opts.sit and opts.jobs > 1:
         parser.error("the -s or --sit argument not avalible with multiple jobs")
+    opts.workers = getattr(opts, "workers", False)
+    if os.environ.get("TEST_POOL") and not opts.workers:
+        sys.stderr.write("# TEST_POOL is ignored, spare machines are only kept with --workers\n")
+    listen = getattr(opts, "listen", None)
+    connect = getattr(opts, "connect", None)
+    if listen and connect:
+        parser.error("the --listen and --connect arguments can't be used together")
+    if opts.sit and (listen or connect):
+        parser.error("the -s or --sit argument not avalible when distributing tests")
 
     opts.address = getattr(opts, "address", None)
     opts.attachments = os.environ.get("TEST_ATTACHMENTS", attachments)
@@ -1111,7 +1984,9 @@ def test_main(options=None, suite=None, attachments=None, **kwargs):
     elif not suite:
         suite = unittest.TestLoader().loadTestsFromModule(__main__)
 
-    runner = TapRunner(verbosity=opts.verbosity, jobs=opts.jobs, thorough=opts.thorough)
+    runner = TapRunner(verbosity=opts.verbosity, jobs=opts.jobs, thorough=opts.thorough,
+                       workers=opts.workers, listen=listen, connect=connect,
+                       results=getattr(opts, "results", None))
     ret = runner.run(suite)
     if not standalone:
         return ret
@@ -17,19 +17,29 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with Cockpit; If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import contextlib
 import errno
 import fcntl
+import functools
+import hashlib
+import json
 import libvirt
 import libvirt_qemu
+import mmap
 import os
+import pipes
 import random
 import re
 import select
+import shutil
 import signal
 import string
+import StringIO
 import socket
+import struct
 import subprocess
+import tarfile
 import tempfile
 import sys
 import threading
@@ -46,6 +56,27 @@ ATOMIC_IMAGES = ["rhel-atomic", "fedora-atomic", "continuous-atomic"]
 
 LOCAL_DIR = os.path.dirname(__file__)
 
+# How much to read from pipes and files at once
+READ_SIZE = 64 * 1024
+
+# How long to trust a running ssh master before asking ssh to check it
+SSH_MASTER_CHECK_INTERVAL = 60
+
+# How long a command through the CommandAgent may take before the agent is
+# considered hung, nothing like ssh keepalives notices that otherwise
+AGENT_TIMEOUT = 15 * 60
+
+def file_checksum(path):
+    """Return the sha256 checksum of a file, as sha256sum prints it"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while True:
+            data = fp.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
 # based on http://stackoverflow.com/a/17753573
 # we use this to quieten down calls
 @contextlib.contextmanager
@@ -98,7 +129,441 @@ class Failure(Exception):
 class RepeatableFailure(Failure):
     pass
 
+class PhaseTimers:
+    """ How long the phases of a test took, by how they nest
+
+        A phase is timed with a "with timers.phase(name)" block or the
+        timed() decorator. Phases nest: the time of "machine.execute"
+        during "setUp" is kept as "setUp/machine.execute", and counts for
+        "setUp" as well. A phase that is entered again inside itself,
+        like an overriding method that calls the one it overrides, is
+        only timed once.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.totals = { }
+
+    def reset(self):
+        with self.lock:
+            self.totals = { }
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stack = self.local.__dict__.setdefault("stack", [ ])
+        if stack and stack[-1] == name:
+            yield
+            return
+        stack.append(name)
+        path = "/".join(stack)
+        start = time.time()
+        try:
+            yield
+        finally:
+            stack.pop()
+            with self.lock:
+                entry = self.totals.setdefault(path, [ 0, 0.0 ])
+                entry[0] += 1
+                entry[1] += time.time() - start
+
+    def results(self):
+        """Return { path: [ count, seconds ] } of the phases that were timed"""
+        with self.lock:
+            return dict((path, [ count, round(seconds, 3) ]) for (path, (count, seconds)) in self.totals.items())
+
+# The phases of the test that this process runs
+timers = PhaseTimers()
+
+def timed(name):
+    """Decorate a function to time it as a phase, see PhaseTimers"""
+    def decorator(func):
+        @functools.wraps(func)
+        def timed_phase(*args, **kwargs):
+            with timers.phase(name):
+                return func(*args, **kwargs)
+        return timed_phase
+    return decorator
+
+# The command agent is a tiny shell loop that runs inside the test machine
+# for as long as the ssh master connection is up. It reads framed requests
+# on stdin and writes framed responses on stdout:
+#
+#   request:  <id> <command length> <input length>\n<command><input>
+#   response: <id> <exit code> <stdout length> <stderr length>\n<stdout><stderr>
+#
+# Both "read" and "head -c" never consume more of stdin than they need, so
+# the frames can be read without any further buffering on the remote side.
+AGENT_SCRIPT = """
+dir=$(mktemp -d) || exit 1
+trap 'rm -rf "$dir"' EXIT
+echo READY
+while read -r id clen ilen; do
+    head -c "$clen" > "$dir/cmd"
+    head -c "$ilen" > "$dir/in"
+    "${SHELL:-/bin/sh}" -c "$(cat "$dir/cmd")" < "$dir/in" > "$dir/out" 2> "$dir/err"
+    code=$?
+    printf '%s %d %d %d\\n' "$id" "$code" $(wc -c < "$dir/out") $(wc -c < "$dir/err")
+    cat "$dir/out" "$dir/err"
+done
+"""
+
+# Commands for Machine.execute_many() are run one after the other in a
+# single shell, and each answers with the same response frame as the agent
+BATCH_SCRIPT_HEAD = """
+dir=$(mktemp -d) || exit 1
+trap 'rm -rf "$dir"' EXIT
+respond() {
+    code=$?
+    printf '%s %d %d %d\\n' "$1" "$code" $(wc -c < "$dir/out") $(wc -c < "$dir/err")
+    cat "$dir/out" "$dir/err"
+}
+"""
+
+BATCH_SCRIPT_COMMAND = """
+"${SHELL:-/bin/sh}" -c %s < /dev/null > "$dir/out" 2> "$dir/err"
+respond %d
+"""
+
+def read_response(fp):
+    """Read one response frame from fp
+
+    Returns a tuple (id, exit code, stdout, stderr), or None if fp
+    ended before a complete frame could be read.
+    """
+    header = fp.readline().split()
+    if len(header) != 4:
+        return None
+    (code, out_len, err_len) = map(int, header[1:])
+    output = fp.read(out_len)
+    error = fp.read(err_len)
+    if len(output) != out_len or len(error) != err_len:
+        return None
+    return (header[0], code, output, error)
+
+class CommandAgent:
+    """ A persistent command channel into the test machine
+
+        The agent is started once over the ssh master connection of a
+        machine, and every command after that is a request/response
+        exchange on its pipes, without forking a local ssh process.
+    """
+    timeout = AGENT_TIMEOUT
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.serial = 0
+        self.proc = None
+
+    def start(self):
+        machine = self.machine
+        cmd = [
+            "env", "-u", "LANGUAGE", "LC_ALL=C",
+            "ssh",
+            "-p", str(machine.ssh_port),
+            "-o", "StrictHostKeyChecking=no",
+            "-o", "UserKnownHostsFile=/dev/null",
+            "-o", "BatchMode=yes",
+            "-o", "ControlPath=" + machine.ssh_master,
+            "-l", machine.vm_username,
+            machine.address,
+            "/bin/sh -c " + pipes.quote(AGENT_SCRIPT)
+        ]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        ret = select.select([self.proc.stdout], [], [], 10)
+        if not ret[0] or self.proc.stdout.readline().strip() != "READY":
+            self.close()
+            return False
+        return True
+
+    def run(self, command, input=None):
+        """Run command in the test machine
+
+        Returns a tuple (exit code, stdout, stderr), or None if the agent
+        isn't usable and the command has not been sent. An agent that goes
+        away or doesn't answer within self.timeout while running a command
+        is closed, and reports the same 255 exit code as ssh.
+        """
+        if not self.proc:
+            return None
+        # The frame counts bytes, not characters
+        if isinstance(command, unicode):
+            command = command.encode("utf-8")
+        input = input or ""
+        if isinstance(input, unicode):
+            input = input.encode("utf-8")
+        self.serial += 1
+        request = "{0} {1} {2}\n".format(self.serial, len(command), len(input)) + command + input
+        try:
+            self.proc.stdin.write(request)
+            self.proc.stdin.flush()
+        except IOError:
+            self.close()
+            return None
+
+        response = self._receive()
+        if not response or response[0] != str(self.serial):
+            self.close()
+            return (255, "", "")
+        return response[1:]
+
+    def _receive(self):
+        """Read one response frame, or return None if it doesn't come in time"""
+        fd = self.proc.stdout.fileno()
+        deadline = time.time() + self.timeout
+        chunks = [ ]
+        size = 0
+        length = None
+        while length is None or size < length:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.machine.message("Command agent didn't answer in {0} seconds".format(self.timeout))
+                return None
+            try:
+                (ready, unused, unused) = select.select([ fd ], [ ], [ ], remaining)
+            except select.error as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+            data = os.read(fd, READ_SIZE)
+            if not data:
+                return None
+            chunks.append(data)
+            size += len(data)
+            if length is None:
+                (header, newline, unused) = "".join(chunks).partition("\n")
+                if newline:
+                    fields = header.split()
+                    if len(fields) != 4 or not all(f.isdigit() for f in fields[1:]):
+                        return None
+                    length = len(header) + 1 + int(fields[2]) + int(fields[3])
+        return read_response(StringIO.StringIO("".join(chunks)))
+
+    def close(self):
+        if self.proc:
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+            self.proc.stdout.close()
+            if self.proc.poll() is None:
+                self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+
+class Reactor:
+    """ A poll loop for the pipes of all asynchronous commands in this process
+
+        There is no thread running it; whoever waits for a command to
+        finish iterates the loop, and that moves all other registered
+        commands along as well.
+    """
+    def __init__(self):
+        self.poll = select.poll()
+        self.handlers = { }
+
+    def register(self, fd, events, callback):
+        self.handlers[fd] = callback
+        self.poll.register(fd, events)
+
+    def unregister(self, fd):
+        if fd in self.handlers:
+            del self.handlers[fd]
+            self.poll.unregister(fd)
+
+    def iterate(self, timeout=10):
+        try:
+            ready = self.poll.poll(timeout * 1000)
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                return
+            raise
+        for (fd, events) in ready:
+            callback = self.handlers.get(fd)
+            if callback:
+                callback(fd, events)
+
+_reactor = None
+
+def reactor():
+    """Return the Reactor of this process"""
+    global _reactor
+    # A forked child can't share the poll object of its parent
+    if not _reactor or _reactor[0] != os.getpid():
+        _reactor = (os.getpid(), Reactor())
+    return _reactor[1]
+
+class ExecuteFuture:
+    """ A command running in a test machine, see Machine.execute_async() """
+    def __init__(self, machine, proc, command, input=None, quiet=False, stream=False):
+        self.machine = machine
+        self.proc = proc
+        self.command = command
+        self.quiet = quiet
+        self.stream = stream
+        self.input = input or ""
+        self.output = [ ]
+        self.exception = None
+        self.value = None
+        self.finished = False
+
+        self.reactor = reactor()
+        self.pipes = {
+            proc.stdin.fileno(): proc.stdin,
+            proc.stdout.fileno(): proc.stdout,
+            proc.stderr.fileno(): proc.stderr
+        }
+        self.reactor.register(proc.stdout.fileno(), select.POLLIN, self._readable)
+        self.reactor.register(proc.stderr.fileno(), select.POLLIN, self._readable)
+        self.reactor.register(proc.stdin.fileno(), select.POLLOUT, self._writable)
+
+    def _close(self, fd):
+        self.reactor.unregister(fd)
+        self.pipes.pop(fd).close()
+        if not self.pipes:
+            self._finish()
+
+    def _readable(self, fd, events):
+        data = os.read(fd, READ_SIZE)
+        if not data:
+            self._close(fd)
+        elif fd == self.proc.stdout.fileno():
+            if self.machine.verbose:
+                sys.stdout.write(data)
+            self.output.append(data)
+        elif not self.quiet or self.machine.verbose:
+            sys.stderr.write(data)
+
+    def _writable(self, fd, events):
+        if events & (select.POLLERR | select.POLLHUP):
+            # The command went away without reading all of its input
+            self.input = ""
+        elif self.input:
+            try:
+                num = os.write(fd, self.input[:READ_SIZE])
+                self.input = self.input[num:]
+            except OSError as ex:
+                if ex.errno != errno.EPIPE:
+                    raise
+                self.input = ""
+        if not self.input:
+            self._close(fd)
+
+    def _finish(self):
+        self.proc.wait()
+        if self.stream:
+            # The output belongs to whoever consumes lines()
+            output = None
+        else:
+            output = "".join(self.output)
+            self.output = None
+        if self.proc.returncode != 0:
+            if self.proc.returncode == 255:
+                self.machine.ssh_master_checked = 0
+            self.exception = subprocess.CalledProcessError(self.proc.returncode, self.command, output=output)
+        else:
+            self.value = output
+        self.finished = True
+
+    def done(self):
+        return self.finished
+
+    def cancel(self):
+        """Stop caring about the command, and kill it if still running"""
+        if not self.finished:
+            for fd in list(self.pipes):
+                self.reactor.unregister(fd)
+                self.pipes.pop(fd).close()
+            if self.proc.poll() is None:
+                self.proc.terminate()
+            self.proc.wait()
+            self.finished = True
+
+    def result(self, timeout=None):
+        """Wait for the command to finish and return its output
+
+        Raises CalledProcessError like Machine.execute() does.
+        """
+        if timeout is not None:
+            end_time = time.time() + timeout
+        while not self.finished:
+            if timeout is None:
+                self.reactor.iterate()
+            else:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    # Don't leave the command running with its pipes in the reactor
+                    self.cancel()
+                    self.exception = Failure("Timeout while waiting for command: {0}".format(self.command))
+                    break
+                self.reactor.iterate(min(remaining, 10))
+        if self.exception:
+            raise self.exception
+        return self.value
+
+    def _stream(self):
+        assert self.stream
+        while True:
+            finished = self.finished
+            if self.output:
+                (chunks, self.output) = (self.output, [ ])
+                for data in chunks:
+                    yield data
+            if finished:
+                break
+            self.reactor.iterate()
+
+    def chunks(self):
+        """Yield the output of the command in chunks as it arrives
+
+        Only available when the future was created with stream=True. At
+        most one read's worth of output per pipe is held in memory at a
+        time. After the last chunk CalledProcessError is raised if the
+        command failed.
+        """
+        for data in self._stream():
+            yield data
+        self.result()
+
+    def lines(self):
+        """Yield the output of the command line by line as it arrives
+
+        Like chunks(), but the lines are yielded without their line ending.
+        """
+        pending = ""
+        for data in self._stream():
+            lines = (pending + data).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        if pending:
+            yield pending
+        self.result()
+
+def gather(*futures):
+    """Wait for all the given ExecuteFutures and return their output
+
+    All commands are allowed to finish, even if one of them fails. The
+    exception of the first failed command is then raised.
+    """
+    for future in futures:
+        while not future.done():
+            future.reactor.iterate()
+    return [ future.result() for future in futures ]
+
+# Configure cockpit.service to run without TLS, used by Machine.start_cockpit()
+COCKPIT_NOTLS_SCRIPT = """#!/bin/sh
+            mkdir -p /etc/systemd/system/cockpit.service.d/ &&
+            rm -f /etc/systemd/system/cockpit.service.d/notls.conf &&
+            systemctl daemon-reload &&
+            printf \"[Service]\nExecStartPre=-/bin/sh -c 'echo 0 > /proc/sys/kernel/yama/ptrace_scope'\nExecStart=\n%s --no-tls\n\" `systemctl cat cockpit.service | grep ExecStart=` > /etc/systemd/system/cockpit.service.d/notls.conf &&
+            systemctl daemon-reload"""
+
 class Machine:
+    # Run commands through a CommandAgent instead of an ssh process each
+    use_agent = os.environ.get("TEST_AGENT", "") not in ("", "0")
+
     def __init__(self, address=None, image=None, verbose=False, label=None, fetch=True):
         self.verbose = verbose
 
@@ -108,6 +573,8 @@ class Machine:
 
         self.image = image or "unknown"
         self.atomic_image = self.image in ATOMIC_IMAGES
+        # Whether start_cockpit() only has to start it
+        self.cockpit_prepared = False
         self.fetch = fetch
         self.vm_username = "root"
         self.address = address
@@ -115,6 +582,8 @@ class Machine:
         self.ssh_master = None
         self.ssh_process = None
         self.ssh_port = 22
+        self.ssh_master_checked = 0
+        self.agent = None
 
     def disconnect(self):
         self._kill_ssh_master()
@@ -125,6 +594,7 @@ class Machine:
             return
         print " ".join(args)
 
+    @timed("machine.start")
     def start(self, maintain=False, macaddr=None, memory_mb=None, cpus=None, wait_for_ip=True):
         """Overridden by machine classes to start the machine"""
         self.message("Assuming machine is already running")
@@ -153,6 +623,7 @@ class Machine:
             (family, socktype, proto, canonname, sockaddr) = addrinfo[0]
             sock = socket.socket(family, socktype, proto)
             sock.settimeout(1)
+            attempt_time = time.time()
             try:
                 sock.connect(sockaddr)
                 return True
@@ -160,7 +631,8 @@ class Machine:
                 pass
             finally:
                 sock.close()
-            time.sleep(0.5)
+            # A connection that timed out has waited long enough already
+            time.sleep(max(0, 0.5 - (time.time() - attempt_time)))
         return False
 
     def wait_user_login(self):
@@ -170,17 +642,24 @@ class Machine:
            user sessions are allowed (and cockit-ws will let "admin"
            in) before declaring a test machine as "booted".
         """
-        tries_left = 60
-        while (tries_left > 0):
+        end_time = time.time() + 60
+        while True:
             try:
                 self.execute("! test -f /run/nologin")
                 return
             except subprocess.CalledProcessError:
                 pass
-            tries_left = tries_left - 1
-            time.sleep(1)
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                break
+            self._wait_user_sessions(min(remaining, 5))
         raise Failure("Timed out waiting for /run/nologin to disappear")
 
+    def _wait_user_sessions(self, timeout_sec):
+        """Overridden by machine classes that know when logins are allowed"""
+        time.sleep(timeout_sec)
+
+    @timed("machine.wait_boot")
     def wait_boot(self):
         """Wait for a machine to boot"""
         assert False, "Cannot wait for a machine we didn't start"
@@ -189,6 +668,7 @@ class Machine:
         """Overridden by machine classes to wait for a machine to stop"""
         assert False, "Cannot wait for a machine we didn't start"
 
+    @timed("machine.kill")
     def kill(self):
         """Overridden by machine classes to unconditionally kill the running machine"""
         assert False, "Cannot kill a machine we didn't start"
@@ -253,6 +733,9 @@ class Machine:
             raise Failure("Couldn't launch an SSH master process")
 
     def _kill_ssh_master(self):
+        if self.agent:
+            self.agent.close()
+            self.agent = None
         if self.ssh_master:
             try:
                 os.unlink(self.ssh_master)
@@ -260,6 +743,7 @@ class Machine:
                 if e.errno != errno.ENOENT:
                     raise
             self.ssh_master = None
+        self.ssh_master_checked = 0
         if self.ssh_process:
             self.ssh_process.stdin.close()
             with Timeout(seconds=90, error_message="Timeout while waiting for ssh master to shut down"):
@@ -284,13 +768,46 @@ class Machine:
         with open(os.devnull, 'w') as devnull:
             code = subprocess.call(cmd, stdin=devnull, stdout=devnull, stderr=devnull)
             if code == 0:
+                self.ssh_master_checked = time.time()
                 return True
         return False
 
+    def _ssh_master_alive(self):
+        # The master process never writes anything after READY, so its
+        # stdout only becomes readable once the connection goes away
+        if not self.ssh_master or not self.ssh_process:
+            return False
+        if self.ssh_process.poll() is not None:
+            return False
+        stdout_fd = self.ssh_process.stdout.fileno()
+        ret = select.select([stdout_fd], [], [], 0)
+        if ret[0] and os.read(stdout_fd, 1024) == "":
+            return False
+        return True
+
     def _ensure_ssh_master(self):
+        # Only fork an "ssh -O check" when the master we started looks
+        # dead, after a failure, or when it hasn't been checked for a while
+        if self._ssh_master_alive() and time.time() - self.ssh_master_checked < SSH_MASTER_CHECK_INTERVAL:
+            return
         if not self._check_ssh_master():
             self._start_ssh_master()
 
+    def _execute_agent(self, command, input):
+        # The agent lives as long as the ssh master, and is started on
+        # first use. If it can't be started, or breaks before a command
+        # is sent, we return None and the caller falls back to ssh.
+        if not self.agent:
+            agent = CommandAgent(self)
+            if not agent.start():
+                self.message("Couldn't start command agent, using ssh")
+                return None
+            self.agent = agent
+        result = self.agent.run(command, input)
+        if not self.agent.proc:
+            self.agent = None
+        return result
+
     def debug_shell(self):
         """Run an interactive shell"""
         cmd = [
@@ -304,25 +821,33 @@ class Machine:
         ]
         subprocess.call(cmd)
 
-    def execute(self, command=None, script=None, input=None, environment={}, stdout=None, quiet=False, direct=False):
-        """Execute a shell command in the test machine and return its output.
-
-        Either specify @command or @script
-
-        Arguments:
-            command: The string to execute by /bin/sh.
-            script: A multi-line script to execute in /bin/sh
-            input: Input to send to the command
-            environment: Additional environmetn variables
-        Returns:
-            The command/script output as a string.
-        """
-        assert command or script
-        assert self.address
-
-        if not direct:
-            self._ensure_ssh_master()
+    def _execute_args(self, command, script, input, environment, quiet):
+        # Returns the arguments for ssh, the input for them and a
+        # description of the command for error messages
+        if command:
+            assert not environment, "Not yet supported"
+            if isinstance(command, basestring):
+                args = [command]
+                if not quiet:
+                    self.message("+", command)
+            else:
+                args = list(command)
+                if not quiet:
+                    self.message("+", *command)
+        else:
+            assert not input, "input not supported to script"
+            args = ["sh", "-s"]
+            if self.verbose:
+                args += ["-x"]
+            input = ""
+            for name, value in environment.items():
+                input += "%s='%s'\n" % (name, value)
+                input += "export %s\n" % name
+            input += script
+            command = "<script>"
+        return (args, input, command)
 
+    def _execute_command(self, args, direct=False):
         # default to no translations; can be overridden in environment
         cmd = [
             "env", "-u", "LANGUAGE", "LC_ALL=C",
@@ -342,106 +867,238 @@ class Machine:
             "-l", self.vm_username,
             self.address
         ]
+        return cmd + args
 
-        if command:
-            assert not environment, "Not yet supported"
-            if isinstance(command, basestring):
-                cmd += [command]
-                if not quiet:
-                    self.message("+", command)
-            else:
-                cmd += command
-                if not quiet:
-                    self.message("+", *command)
-        else:
-            assert not input, "input not supported to script"
-            cmd += ["sh", "-s"]
-            if self.verbose:
-                cmd += ["-x"]
-            input = ""
-            for name, value in environment.items():
-                input += "%s='%s'\n" % (name, value)
-                input += "export %s\n" % name
-            input += script
-            command = "<script>"
+    @timed("machine.execute")
+    def execute(self, command=None, script=None, input=None, environment={}, stdout=None, quiet=False, direct=False):
+        """Execute a shell command in the test machine and return its output.
+
+        Either specify @command or @script
+
+        Arguments:
+            command: The string to execute by /bin/sh.
+            script: A multi-line script to execute in /bin/sh
+            input: Input to send to the command
+            environment: Additional environmetn variables
+        Returns:
+            The command/script output as a string.
+        """
+        assert command or script
+        assert self.address
+
+        if not direct:
+            self._ensure_ssh_master()
+
+        (args, input, command) = self._execute_args(command, script, input, environment, quiet)
+
+        if self.use_agent and not direct and not stdout:
+            result = self._execute_agent(" ".join(args), input)
+            if result is not None:
+                (code, output, error) = result
+                if self.verbose:
+                    sys.stdout.write(output)
+                if error and (not quiet or self.verbose):
+                    sys.stderr.write(error)
+                if code != 0:
+                    if code == 255:
+                        self.ssh_master_checked = 0
+                    raise subprocess.CalledProcessError(code, command, output=output)
+                return output
+
+        cmd = self._execute_command(args, direct)
 
         if stdout:
             subprocess.call(cmd, stdout=stdout)
             return
 
-        output = ""
+        # The pipes are handled in the shared poll loop, see ExecuteFuture
         proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdin_fd = proc.stdin.fileno()
-        stdout_fd = proc.stdout.fileno()
-        stderr_fd = proc.stderr.fileno()
-        rset = [stdout_fd, stderr_fd]
-        wset = [stdin_fd]
-        while len(rset) > 0 or len(wset) > 0:
-            ret = select.select(rset, wset, [], 10)
-            for fd in ret[0]:
-                if fd == stdout_fd:
-                    data = os.read(fd, 1024)
-                    if data == "":
-                        rset.remove(stdout_fd)
-                        proc.stdout.close()
-                    else:
-                        if self.verbose:
-                            sys.stdout.write(data)
-                        output += data
-                elif fd == stderr_fd:
-                    data = os.read(fd, 1024)
-                    if data == "":
-                        rset.remove(stderr_fd)
-                        proc.stderr.close()
-                    elif not quiet or self.verbose:
-                        sys.stderr.write(data)
-            for fd in ret[1]:
-                if fd == stdin_fd:
-                    if input:
-                        num = os.write(fd, input)
-                        input = input[num:]
-                    if not input:
-                        wset.remove(stdin_fd)
-                        proc.stdin.close()
-        proc.wait()
-
-        if proc.returncode != 0:
-            raise subprocess.CalledProcessError(proc.returncode, command, output=output)
-        return output
+        return ExecuteFuture(self, proc, command, input=input, quiet=quiet).result()
 
-    def upload(self, sources, dest):
-        """Upload a file into the test machine
+    def execute_async(self, command=None, script=None, input=None, environment={}, quiet=False):
+        """Start a shell command in the test machine without waiting for it.
+
+        The arguments are the same as for execute(). Commands started this
+        way all run concurrently, on this machine or on several, driven by
+        a single poll loop for the whole process.
+
+        Returns:
+            An ExecuteFuture. Its result() method waits for the command and
+            returns its output, or raises CalledProcessError like execute().
+            Use gather() to wait for several of them.
+        """
+        assert command or script
+        assert self.address
+
+        self._ensure_ssh_master()
+        (args, input, command) = self._execute_args(command, script, input, environment, quiet)
+        proc = subprocess.Popen(self._execute_command(args),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return ExecuteFuture(self, proc, command, input=input, quiet=quiet)
+
+    def execute_stream(self, command=None, script=None, input=None, environment={}, quiet=False, lines=True):
+        """Execute a shell command in the test machine and yield its output.
+
+        The arguments are the same as for execute(), but instead of
+        returning all output at once, it is yielded as it arrives, so
+        that memory use stays bounded even for huge outputs.
 
         Arguments:
-            sources: the array of paths of the file to upload
-            dest: the file path in the machine to upload to
+            lines: Yield lines without line endings if True, otherwise
+                chunks of raw output as they are read.
+        Raises:
+            CalledProcessError: After the end of the output if the command failed.
         """
-        assert sources and dest
+        assert command or script
         assert self.address
 
         self._ensure_ssh_master()
+        (args, input, command) = self._execute_args(command, script, input, environment, quiet)
+        proc = subprocess.Popen(self._execute_command(args),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        future = ExecuteFuture(self, proc, command, input=input, quiet=quiet, stream=True)
+        try:
+            for data in (future.lines() if lines else future.chunks()):
+                yield data
+        finally:
+            future.cancel()
 
-        cmd = [
-            "scp", "-B",
-            "-r", "-p",
-            "-o", "StrictHostKeyChecking=no",
-            "-o", "UserKnownHostsFile=/dev/null",
-            "-o", "ControlPath=" + self.ssh_master,
-            "-o", "BatchMode=yes",
-          ]
-        if not self.verbose:
-            cmd += [ "-q" ]
+    @timed("machine.execute_many")
+    def execute_many(self, commands):
+        """Execute several shell commands in one session on the test machine.
+
+        The commands run one after the other, each in its own shell, but
+        they all share a single round trip to the machine.
+
+        Arguments:
+            commands: A list of strings to execute by /bin/sh.
+        Returns:
+            A list with a (exit code, stdout, stderr) tuple for each command,
+            in the same order. Unlike execute() no exception is raised when
+            a command fails.
+        """
+        assert self.address
+        if not commands:
+            return [ ]
+
+        script = BATCH_SCRIPT_HEAD
+        for i, command in enumerate(commands):
+            self.message("+", command)
+            script += BATCH_SCRIPT_COMMAND % (pipes.quote(command), i)
+        output = self.execute(script=script, quiet=True)
+
+        results = [ ]
+        fp = StringIO.StringIO(output)
+        for i in range(len(commands)):
+            response = read_response(fp)
+            if not response or response[0] != str(i):
+                raise Failure("Invalid response from batch of commands: {0}".format(commands[i]))
+            results.append(response[1:])
+        return results
+
+    @timed("machine.upload")
+    def upload(self, sources, dest, compress=False):
+        """Upload files into the test machine
+
+        The files are streamed as a tar archive over the ssh connection.
+        Files that already exist in the machine with the same content
+        are not transferred again.
+
+        Arguments:
+            sources: the array of paths of the files or directories to upload
+            dest: the file path in the machine to upload to
+            compress: compress the data with gzip while transferring
+        Returns:
+            A dict with the number of "files" and "bytes" transferred, the
+            number of unchanged files "skipped" and the "seconds" it took.
+        """
+        assert sources and dest
+        assert self.address
+
+        start = time.time()
+        self.message("Uploading", ", ".join(sources))
 
         def relative_to_test_dir(path):
             return os.path.join(LOCAL_DIR, "..", path)
-        cmd += map(relative_to_test_dir, sources)
 
-        cmd += [ "%s@[%s]:%s" % (self.vm_username, self.address, dest) ]
+        # A list of (local path, path relative to the destination directory)
+        # When dest is not a directory, a single source is renamed, like scp does
+        entries = [ ]
+        for source in map(relative_to_test_dir, sources):
+            source = os.path.normpath(source)
+            base = os.path.basename(source)
+            entries.append((source, base))
+            if os.path.isdir(source):
+                for root, dirs, files in os.walk(source, followlinks=True):
+                    for name in sorted(dirs + files):
+                        path = os.path.join(root, name)
+                        entries.append((path, os.path.join(base, os.path.relpath(path, source))))
+            elif not os.path.exists(source):
+                raise Failure("Cannot upload {0}: No such file or directory".format(source))
+
+        def renamed(name):
+            (first, sep, rest) = name.partition("/")
+            return os.path.basename(dest) + sep + rest
+
+        hashes = { }
+        for (path, name) in entries:
+            if not os.path.isdir(path):
+                hashes[name] = file_checksum(path)
+
+        # The checksums of what's already in the machine
+        names = " ".join(map(pipes.quote, hashes.keys()))
+        single = len(sources) == 1
+        script = "if [ -d {0} ]; then\n    echo dir\n    cd {0} && sha256sum -- {1} < /dev/null\n".format(pipes.quote(dest), names)
+        if single:
+            script += "else\n    echo file\n    cd {0} && sha256sum -- {1} < /dev/null\n".format(pipes.quote(os.path.dirname(dest) or "."),
+                                                                                   " ".join(map(pipes.quote, map(renamed, hashes.keys()))))
+        script += "fi 2>/dev/null\ntrue\n"
+        output = self.execute(script=script, quiet=True).splitlines()
+
+        if output and output[0] == "dir":
+            directory = dest
+        elif single:
+            directory = os.path.dirname(dest) or "."
+            entries = [ (path, renamed(name)) for (path, name) in entries ]
+            hashes = dict([ (renamed(name), value) for (name, value) in hashes.items() ])
+        else:
+            raise Failure("Cannot upload several files to {0}: Not a directory".format(dest))
+
+        existing = { }
+        for line in output[1:]:
+            (value, sep, name) = line.partition("  ")
+            existing[name] = value
 
-        self.message("Uploading", ", ".join(sources))
-        self.message(" ".join(cmd))
-        subprocess.check_call(cmd)
+        transfer = [ (path, name) for (path, name) in entries if name not in hashes or hashes[name] != existing.get(name) ]
+        stats = { "files": 0, "bytes": 0, "skipped": len(hashes) }
+
+        if not hashes or any(name in hashes for (path, name) in transfer):
+            tar_cmd = "tar --no-same-owner -C {0} -x{1}f -".format(pipes.quote(directory), compress and "z" or "")
+            self._ensure_ssh_master()
+            proc = subprocess.Popen(self._execute_command([tar_cmd]), stdin=subprocess.PIPE)
+            try:
+                tar = tarfile.open(fileobj=proc.stdin, mode=compress and "w|gz" or "w|", dereference=True)
+                for (path, name) in transfer:
+                    tar.add(path, arcname=name, recursive=False)
+                    if name in hashes:
+                        stats["files"] += 1
+                        stats["bytes"] += os.path.getsize(path)
+                tar.close()
+                proc.stdin.close()
+            except IOError as ex:
+                # tar in the machine went away, its exit code tells more
+                if ex.errno != errno.EPIPE:
+                    raise
+            proc.wait()
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, tar_cmd)
+            stats["skipped"] -= stats["files"]
+
+        stats["seconds"] = time.time() - start
+        self.message("Uploaded {files} files, {bytes} bytes in {seconds:.1f}s, {skipped} unchanged".format(**stats))
+        return stats
 
+    @timed("machine.download")
     def download(self, source, dest):
         """Download a file from the test machine.
         """
@@ -467,36 +1124,72 @@ class Machine:
         self.message(" ".join(cmd))
         subprocess.check_call(cmd)
 
-    def download_dir(self, source, dest):
+    @timed("machine.download_dir")
+    def download_dir(self, source, dest, include=None, exclude=None, max_size=None):
         """Download a directory from the test machine, recursively.
+
+        The files are packed with tar and gzip in the machine and streamed
+        over the ssh connection. Downloaded files are readable by everyone.
+
+        Arguments:
+            source: the directory in the machine to download
+            dest: the local directory to download to, like with scp -r
+            include: only download files whose names match one of these
+                shell patterns
+            exclude: don't download files whose names match one of these
+                shell patterns
+            max_size: stop after this many bytes of files
+        Returns:
+            The number of bytes downloaded.
         """
         assert source and dest
         assert self.address
 
         self._ensure_ssh_master()
         dest = os.path.join(LOCAL_DIR, "..", dest)
-
-        cmd = [
-            "scp", "-B",
-            "-P", str(self.ssh_port),
-            "-o", "StrictHostKeyChecking=no",
-            "-o", "UserKnownHostsFile=/dev/null",
-            "-o", "ControlPath=" + self.ssh_master,
-            "-o", "BatchMode=yes",
-            "-r",
-          ]
-        if not self.verbose:
-            cmd += ["-q"]
-        cmd += [ "%s@[%s]:%s" % (self.vm_username, self.address, source), dest ]
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(source))
+
+        find = "find -L . -type f"
+        if include:
+            find += " \\( " + " -o ".join([ "-name " + pipes.quote(p) for p in include ]) + " \\)"
+        for pattern in exclude or [ ]:
+            find += " ! -name " + pipes.quote(pattern)
+        if max_size:
+            find += " -size -{0}c".format(max_size + 1)
+        command = "cd {0} && {1} -print0 | tar --null -T - --dereference --hard-dereference -czf -".format(pipes.quote(source), find)
 
         self.message("Downloading", source)
-        self.message(" ".join(cmd))
+        size = 0
+        proc = subprocess.Popen(self._execute_command([command]), stdout=subprocess.PIPE)
         try:
-            subprocess.check_call(cmd)
-            target = os.path.join(dest, os.path.basename(source))
-            subprocess.check_call([ "find", target, "-type", "f", "-exec", "chmod", "0644", "{}", ";" ])
+            if not os.path.isdir(dest):
+                os.makedirs(dest)
+            tar = tarfile.open(fileobj=proc.stdout, mode="r|gz")
+            for member in tar:
+                name = os.path.normpath(member.name)
+                if not member.isfile() or name.startswith("..") or os.path.isabs(name):
+                    continue
+                if max_size and size + member.size > max_size:
+                    self.message("Download of '{0}' exceeds {1} bytes, skipping the rest".format(source, max_size))
+                    break
+                path = os.path.join(dest, name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+                with os.fdopen(fd, "w") as fp:
+                    shutil.copyfileobj(tar.extractfile(member), fp, READ_SIZE)
+                os.chmod(path, 0644)
+                size += member.size
+            tar.close()
         except:
             self.message("Error while downloading directory '{0}'".format(source))
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+        return size
 
     def write(self, dest, content):
         """Write a file into the test machine
@@ -528,8 +1221,29 @@ class Machine:
         os.chmod(identity, 0600)
         return identity
 
-    def journal_messages(self, syslog_ids, log_level):
-        """Return interesting journal messages"""
+    def _stream_messages(self, cmd, ignore, noise):
+        # The lines for which ignore(line) is true are dropped as they
+        # arrive, and a single line containing one of noise means no lines
+        messages = [ ]
+        count = 0
+        first = None
+        for data in self.execute_stream(cmd):
+            for line in data.splitlines() or [ "" ]:
+                count += 1
+                if count == 1:
+                    first = line
+                if not ignore or not ignore(line):
+                    messages.append(line)
+        if count == 1 and any(n in first for n in noise):
+            return [ ]
+        return messages
+
+    def journal_messages(self, syslog_ids, log_level, ignore=None):
+        """Return interesting journal messages
+
+        The messages for which ignore(message) is true are dropped while
+        they are read, so that a long journal isn't kept in memory.
+        """
 
         # Journald does not always set trusted fields like
         # _SYSTEMD_UNIT or _EXE correctly for the last few messages of
@@ -544,20 +1258,12 @@ class Machine:
         # itself in the returned messages.
 
         cmd = "journalctl 2>&1 -o cat -p %d %s || true" % (log_level, matches)
-        messages = self.execute(cmd).splitlines()
-        if len(messages) == 1 and ("Cannot assign requested address" in messages[0]
-                                   or "-- No entries --" in messages[0]):
-            # No messages
-            return [ ]
-        else:
-            return messages
+        return self._stream_messages(cmd, ignore, [ "Cannot assign requested address", "-- No entries --" ])
 
-    def audit_messages(self, type_pref):
+    def audit_messages(self, type_pref, ignore=None):
+        """Return audit messages of the given type, see journal_messages()"""
         cmd = "journalctl -o cat SYSLOG_IDENTIFIER=kernel 2>&1 | grep 'type=%s.*audit' || true" % (type_pref, )
-        messages = self.execute(cmd).splitlines()
-        if len(messages) == 1 and "Cannot assign requested address" in messages[0]:
-            messages = [ ]
-        return messages
+        return self._stream_messages(cmd, ignore, [ "Cannot assign requested address" ])
 
     def get_admin_group(self):
         if "debian" in self.image or "ubuntu" in self.image:
@@ -565,6 +1271,7 @@ class Machine:
         else:
             return "wheel"
 
+    @timed("machine.start_cockpit")
     def start_cockpit(self, atomic_wait_for_host="localhost", tls=False):
         """Start Cockpit.
 
@@ -590,39 +1297,386 @@ class Machine:
             if atomic_wait_for_host:
                 self.wait_for_cockpit_running(atomic_wait_for_host)
         elif tls:
+            # Without notls.conf, there is nothing prepared anymore
+            self.cockpit_prepared = False
             self.execute(script="""#!/bin/sh
             rm -f /etc/systemd/system/cockpit.service.d/notls.conf &&
             systemctl daemon-reload &&
             systemctl start cockpit.socket
             """)
+        elif self.cockpit_prepared:
+            # The machine started from a prepared image, see VirtMachine.prepared
+            self.execute("systemctl start cockpit.socket")
         else:
-            self.execute(script="""#!/bin/sh
-            mkdir -p /etc/systemd/system/cockpit.service.d/ &&
-            rm -f /etc/systemd/system/cockpit.service.d/notls.conf &&
-            systemctl daemon-reload &&
-            printf \"[Service]\nExecStartPre=-/bin/sh -c 'echo 0 > /proc/sys/kernel/yama/ptrace_scope'\nExecStart=\n%s --no-tls\n\" `systemctl cat cockpit.service | grep ExecStart=` > /etc/systemd/system/cockpit.service.d/notls.conf &&
-            systemctl daemon-reload &&
+            self.execute(script=COCKPIT_NOTLS_SCRIPT + """ &&
             systemctl start cockpit.socket
             """)
 
-    def restart_cockpit(self):
-        """Restart Cockpit.
+    @timed("machine.restart_cockpit")
+    def restart_cockpit(self):
+        """Restart Cockpit.
+        """
+        if self.atomic_image:
+            with Timeout(seconds=90, error_message="Timeout while waiting for cockpit/ws to restart"):
+                self.execute("docker restart `docker ps | grep cockpit/ws | awk '{print $1;}'`")
+            self.wait_for_cockpit_running()
+        else:
+            self.execute("systemctl restart cockpit")
+
+    def stop_cockpit(self):
+        """Stop Cockpit.
+        """
+        if self.atomic_image:
+            with Timeout(seconds=60, error_message="Timeout while waiting for cockpit/ws to stop"):
+                self.execute("docker kill `docker ps | grep cockpit/ws | awk '{print $1;}'`")
+        else:
+            self.execute("systemctl stop cockpit.socket")
+
+# Netlink constants for neighbour (ARP) table notifications, see rtnetlink(7)
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_NEIGH = 0x4
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+NDA_DST = 1
+NDA_LLADDR = 2
+
+# How often the neighbour table is read in full, in case events were lost
+NEIGHBOUR_RESYNC_INTERVAL = 10
+
+class NeighbourTable:
+    """ An index of MAC to IP addresses from the kernel's neighbour (ARP) table
+
+        A thread in the background follows changes of the table through
+        netlink, and wakes up everyone waiting for an address as soon as it
+        shows up. The table is also read in full from /proc/net/arp at
+        startup, after lost events, and every NEIGHBOUR_RESYNC_INTERVAL. When
+        netlink isn't available, or its socket breaks, the thread reads
+        /proc/net/arp once a second, and tries to open netlink again.
+        Use neighbours() to get the table shared by all machines of a process.
+    """
+    def __init__(self):
+        self.addresses = { }
+        self.interfaces = { }
+        self.data_lock = threading.RLock()
+        self.signal_condition = threading.Condition(self.data_lock)
+
+        self.sock = self._open()
+        self.resync()
+        self.thread = threading.Thread(target=self._run, name="neighbourTable")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def resync(self):
+        # Get address from the arp arp output looks like this.
+        #
+        # IP address     HW type  Flags  HW address         Mask  Device
+        # 10.111.118.45  0x1      0x0    9e:00:03:72:00:04  *     cockpit1
+        # ...
+        with open("/proc/net/arp", "r") as fp:
+            output = fp.read()
+        addresses = { }
+        for line in output.split("\n")[1:]:
+            parts = re.split(' +', line)
+            if len(parts) > 5:
+                addresses[(parts[5], parts[3].lower())] = parts[0]
+        with self.data_lock:
+            if addresses != self.addresses:
+                self.addresses = addresses
+                self.signal_condition.notifyAll()
+        return output
+
+    def _open(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        except (AttributeError, socket.error):
+            return None
+        try:
+            # Link changes tell us when interface indexes get reused
+            sock.bind((0, RTMGRP_NEIGH | RTMGRP_LINK))
+        except socket.error:
+            sock.close()
+            return None
+        return sock
+
+    def _interface_name(self, index):
+        if index not in self.interfaces:
+            for name in os.listdir("/sys/class/net"):
+                try:
+                    with open(os.path.join("/sys/class/net", name, "ifindex"), "r") as fp:
+                        self.interfaces[int(fp.read())] = name
+                except (IOError, ValueError):
+                    pass
+        return self.interfaces.get(index)
+
+    def _parse(self, data):
+        offset = 0
+        while offset + 16 <= len(data):
+            (length, kind) = struct.unpack_from("=IH", data, offset)
+            if length < 16 or offset + length > len(data):
+                break
+            if kind in (RTM_NEWLINK, RTM_DELLINK):
+                self.interfaces = { }
+            elif kind in (RTM_NEWNEIGH, RTM_DELNEIGH) and length >= 28:
+                (family, ifindex) = struct.unpack_from("=B3xi", data, offset + 16)
+                dst = lladdr = None
+                pos = offset + 28
+                while pos + 4 <= offset + length:
+                    (alen, atype) = struct.unpack_from("=HH", data, pos)
+                    if alen < 4:
+                        break
+                    value = data[pos + 4:pos + alen]
+                    if atype == NDA_DST and family == socket.AF_INET and len(value) == 4:
+                        dst = socket.inet_ntoa(value)
+                    elif atype == NDA_LLADDR and len(value) == 6:
+                        lladdr = ":".join("%02x" % ord(c) for c in value)
+                    pos += (alen + 3) & ~3
+                name = self._interface_name(ifindex)
+                if dst and lladdr and name:
+                    key = (name, lladdr)
+                    with self.data_lock:
+                        if kind == RTM_NEWNEIGH:
+                            self.addresses[key] = dst
+                            self.signal_condition.notifyAll()
+                        elif self.addresses.get(key) == dst:
+                            del self.addresses[key]
+            offset += (length + 3) & ~3
+
+    def _run(self):
+        while True:
+            try:
+                self._iterate()
+            except (EnvironmentError, select.error) as ex:
+                # Don't let the thread die, everyone waiting for an address would hang
+                sys.stderr.write("WARNING: Following the neighbour table failed: {0}\n".format(ex))
+                if self.sock:
+                    self.sock.close()
+                    self.sock = None
+                with self.data_lock:
+                    self.signal_condition.notifyAll()
+                time.sleep(1)
+
+    def _iterate(self):
+        if not self.sock:
+            time.sleep(1)
+            self.sock = self._open()
+            self.resync()
+            return
+        (ready, unused, unused) = select.select([self.sock], [], [], NEIGHBOUR_RESYNC_INTERVAL)
+        if not ready:
+            self.resync()
+            return
+        try:
+            self._parse(self.sock.recv(READ_SIZE))
+        except socket.error as ex:
+            # The kernel drops events when we don't keep up
+            if ex.errno != errno.ENOBUFS:
+                raise
+            self.resync()
+
+    def lookup(self, mac, interface):
+        with self.data_lock:
+            return self.addresses.get((interface, mac.lower()))
+
+    def wait_for_address(self, mac, interface, timeout_sec=300):
+        """Return the IP address of the given MAC, or None on timeout"""
+        end_time = time.time() + timeout_sec
+        with self.signal_condition:
+            while True:
+                address = self.lookup(mac, interface)
+                remaining_time = end_time - time.time()
+                if address or remaining_time <= 0:
+                    return address
+                self.signal_condition.wait(remaining_time)
+
+_neighbours = None
+
+def neighbours():
+    """Return the NeighbourTable of this process"""
+    global _neighbours
+    # Threads don't survive a fork, so a child needs its own table
+    if not _neighbours or _neighbours[0] != os.getpid():
+        _neighbours = (os.getpid(), NeighbourTable())
+    return _neighbours[1]
+
+def parse_size(size):
+    """Parse a disk size like "50M" the way qemu-img does"""
+    size = str(size).strip()
+    units = { "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4 }
+    factor = units.get(size[-1:].lower())
+    if factor:
+        size = size[:-1]
+    try:
+        return int(float(size) * (factor or 1))
+    except ValueError:
+        raise Failure("Invalid disk size: " + size)
+
+def process_stamp(pid):
+    """Identify a running process, in a way that survives reuse of its pid"""
+    try:
+        with open("/proc/%d/stat" % pid, "r") as fp:
+            stat = fp.read()
+    except IOError:
+        return None
+    # The start time is field 22, and the command in field 2 may contain spaces
+    return int(stat.rpartition(")")[2].split()[19])
+
+class ResourceAllocator:
+    """ Numbered resources of a host, like mac addresses or disk slots
+
+        The allocation table of each kind of resource is a file in
+        .cockpit-test-resources, shared by all processes. Each slot holds
+        the pid and start time of the process that owns it, and is free
+        when it's zero or when that process is gone. So resources of
+        crashed processes come back by themselves. A hint in the header
+        makes allocate() continue after the last allocated slot. All
+        access to the table happens under a short flock.
+    """
+    header = struct.Struct("=I")
+    slot = struct.Struct("=iQ")
+
+    def __init__(self, name, size):
+        self.path = os.path.join(tempfile.gettempdir(), ".cockpit-test-resources", name + ".table")
+        self.size = size
+
+    @contextlib.contextmanager
+    def _table(self):
+        length = self.header.size + self.size * self.slot.size
+        try:
+            os.makedirs(os.path.dirname(self.path), 0755)
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size < length:
+                os.ftruncate(fd, length)
+            table = mmap.mmap(fd, length)
+            try:
+                yield table
+            finally:
+                table.close()
+        finally:
+            os.close(fd)
+
+    def _offset(self, index):
+        return self.header.size + index * self.slot.size
+
+    def _is_free(self, table, index):
+        (pid, stamp) = self.slot.unpack_from(table, self._offset(index))
+        return pid == 0 or process_stamp(pid) != stamp
+
+    def _take(self, table, index):
+        pid = os.getpid()
+        self.slot.pack_into(table, self._offset(index), pid, process_stamp(pid))
+        self.header.pack_into(table, 0, (index + 1) % self.size)
+
+    def allocate(self, lowest=False):
+        """Return the index of a free slot, which is now ours
+
+        With lowest the search starts at the first slot instead of the hint.
         """
-        if self.atomic_image:
-            with Timeout(seconds=90, error_message="Timeout while waiting for cockpit/ws to restart"):
-                self.execute("docker restart `docker ps | grep cockpit/ws | awk '{print $1;}'`")
-            self.wait_for_cockpit_running()
-        else:
-            self.execute("systemctl restart cockpit")
+        with self._table() as table:
+            (hint, ) = self.header.unpack_from(table, 0)
+            if lowest:
+                hint = 0
+            for i in range(self.size):
+                index = (hint + i) % self.size
+                if self._is_free(table, index):
+                    self._take(table, index)
+                    return index
+        raise Failure("No free slots left in " + self.path)
+
+    def claim(self, index):
+        """Take the given slot, unless it belongs to someone else"""
+        with self._table() as table:
+            (pid, stamp) = self.slot.unpack_from(table, self._offset(index))
+            if pid != os.getpid() and not self._is_free(table, index):
+                return False
+            self._take(table, index)
+            return True
 
-    def stop_cockpit(self):
-        """Stop Cockpit.
+    def release(self, index):
+        with self._table() as table:
+            (pid, stamp) = self.slot.unpack_from(table, self._offset(index))
+            if pid == os.getpid():
+                self.slot.pack_into(table, self._offset(index), 0, 0)
+
+class ScratchDisks:
+    """ A pool of sparse raw disk images in a directory, for VirtMachine.add_disk()
+
+        The image slots are shared by all test processes of a host, and
+        handed out by a ResourceAllocator, which gives out the lowest free
+        slot. The image of a slot stays around for the next test, and
+        acquire() resets it by truncating it to nothing and then to the
+        requested size, which discards the old contents without running
+        qemu-img or creating a file. An image that a guest might still
+        have open is removed by release() instead, and created anew.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.slots = ResourceAllocator("disks", 1024)
+
+    def acquire(self, size):
+        """Return the path and slot of a fresh image of size bytes
+
+        The image stays ours until it is passed to release().
         """
-        if self.atomic_image:
-            with Timeout(seconds=60, error_message="Timeout while waiting for cockpit/ws to stop"):
-                self.execute("docker kill `docker ps | grep cockpit/ws | awk '{print $1;}'`")
-        else:
-            self.execute("systemctl stop cockpit.socket")
+        try:
+            os.makedirs(self.directory, 0750)
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        slot = self.slots.allocate(lowest=True)
+        path = os.path.join(self.directory, "scratch-%d.img" % slot)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0640)
+        try:
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        return (path, slot)
+
+    def release(self, path, slot, in_use=False):
+        """Give back the image of a slot for reuse
+
+        With in_use the image is removed, since a guest might still write to it.
+        """
+        if in_use and os.path.exists(path):
+            os.unlink(path)
+        self.slots.release(slot)
+
+# How many events of each domain VirtEventHandler remembers
+DOMAIN_EVENT_HISTORY = 32
+
+class DomainEvents:
+    """ The state and recent events of one domain, see VirtEventHandler
+
+        The history holds (time, status, detail) tuples, with a status
+        of "Rebooted" for reboots.
+    """
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        self.status = None
+        self.rebooted = False
+        self.history = collections.deque(maxlen=DOMAIN_EVENT_HISTORY)
+
+    def add(self, status, detail=None):
+        self.history.append((time.time(), status, detail))
+        self.condition.notifyAll()
+
+    def is_running(self):
+        return self.status is not None and self.status['status'] in ["Started", "Resumed"]
+
+    def is_stopped(self):
+        return self.status in [{'status': 'Shutdown', 'detail': 'Finished'},
+                               {'status': 'Stopped', 'detail': 'Shutdown'}]
+
+    def since(self, when):
+        return [event for event in self.history if event[0] >= when]
 
 class VirtEventHandler():
     """ VirtEventHandler registers event handlers (currently: boot, resume, reboot) for libvirt domain instances
@@ -630,14 +1684,14 @@ class VirtEventHandler():
         references to be from the same connection instance!
         A thread in the background will run the libvirt event loop. Convenience functions wait_for_reboot,
         wait_for_running and wait_for_stopped exist (with timeouts).
-        Access to the datastructures is mutex-protected, with an additional threading.Condition object
-        for signaling new events (to avoid polling in the wait* convenience functions).
+        Access to the datastructures is mutex-protected. Each domain has its own DomainEvents with a
+        threading.Condition object for signaling its new events (to avoid polling in the wait* convenience
+        functions), so waiters only wake up for events of their own domain.
         It is expected for the caller to register new domains and if possible deregister them for the callbacks.
     """
     def __init__(self, libvirt_connection, verbose = False):
         self.eventLoopThread = None
-        self.domain_status = { }
-        self.domain_has_rebooted = { }
+        self.domains = { }
         self.verbose = verbose
         self.connection = libvirt_connection
 
@@ -645,10 +1699,9 @@ class VirtEventHandler():
         self.registered_callbacks = { }
 
         self.data_lock = threading.RLock()
-        self.signal_condition = threading.Condition(self.data_lock)
 
         # only show debug messages for specific domains, since
-        # we might have multiple event handlers at any given time
+        # all machines of a process share one event handler
         self.debug_domains = []
 
         self.virEventLoopNativeStart()
@@ -667,24 +1720,27 @@ class VirtEventHandler():
     # a regular reboot doesn't affect the started/stopped state of the domain
     @staticmethod
     def domain_event_reboot_callback(conn, dom, event_handler):
-        key = (dom.name(), dom.ID())
         with event_handler.data_lock:
-            if not key in event_handler.domain_has_rebooted or event_handler.domain_has_rebooted[key] != True:
+            events = event_handler.domain_events(dom)
+            if not events.rebooted:
                 if event_handler.verbose and dom.name() in event_handler.debug_domains:
                     sys.stderr.write("[%s] REBOOT: Domain '%s' (ID %s)\n" % (str(time.time()), dom.name(), dom.ID()))
-                event_handler.domain_has_rebooted[key] = True
-                event_handler.signal_condition.notifyAll()
+                events.rebooted = True
+                events.add("Rebooted")
 
     @staticmethod
     def domain_event_callback(conn, dom, event, detail, event_handler):
-        key = (dom.name(), dom.ID())
         value = { 'status': event_handler.dom_event_to_string(event),
                   'detail': event_handler.dom_detail_to_string(event, detail)
                 }
         with event_handler.data_lock:
-            if not key in event_handler.domain_status or event_handler.domain_status[key] != value:
-                event_handler.domain_status[key] = value
-                event_handler.signal_condition.notifyAll()
+            # don't bring back domains that were forgotten when they went away
+            if value['status'] in ["Stopped", "Undefined"] and not event_handler.knows_domain(dom):
+                return
+            events = event_handler.domain_events(dom)
+            if events.status != value:
+                events.status = value
+                events.add(value['status'], value['detail'])
                 if event_handler.verbose and dom.name() in event_handler.debug_domains:
                     sys.stderr.write("[%s] EVENT: Domain '%s' (ID %s) %s %s\n" % (
                             str(time.time()),
@@ -741,68 +1797,77 @@ class VirtEventHandler():
             )
         return domEventStrings[event][detail]
 
+    def domain_events(self, domain):
+        """Return the DomainEvents of domain, the caller holds data_lock"""
+        key = (domain.name(), domain.ID())
+        if key not in self.domains:
+            self.domains[key] = DomainEvents(self.data_lock)
+        return self.domains[key]
+
+    def knows_domain(self, domain):
+        with self.data_lock:
+            return (domain.name(), domain.ID()) in self.domains
+
+    def forget_domain(self, domain):
+        with self.data_lock:
+            self.domains.pop((domain.name(), domain.ID()), None)
+
     def reset_domain_status(self, domain):
         with self.data_lock:
-            key = (domain.name(), domain.ID())
-            if key in self.domain_status:
-                del self.domain_status[key]
+            self.domain_events(domain).status = None
 
     def reset_domain_reboot_status(self, domain):
         with self.data_lock:
-            key = (domain.name(), domain.ID())
-            if key in self.domain_has_rebooted:
-                del self.domain_has_rebooted[key]
+            self.domain_events(domain).rebooted = False
 
-    # reboot flag should have probably been reset before this
-    # returns whether domain has rebooted
-    def wait_for_reboot(self, domain, timeout_sec=120):
-        start_time = time.time()
-        end_time = start_time + timeout_sec
-        key = (domain.name(), domain.ID())
+    def events_since(self, domain, when):
+        """Return the (time, status, detail) events of domain since when"""
         with self.data_lock:
-            if key in self.domain_has_rebooted:
-                return True
-        remaining_time = end_time - time.time()
-        with self.signal_condition:
-            while remaining_time > 0:
-                # wait for a domain event or our timeout
-                self.signal_condition.wait(remaining_time)
-                if key in self.domain_has_rebooted:
+            return self.domain_events(domain).since(when)
+
+    def wait_for(self, domain, predicate, timeout_sec=120, recheck_sec=None):
+        """Wait until predicate(events) is true for the DomainEvents of domain
+
+        The predicate is checked whenever the domain has a new event, or
+        every recheck_sec for things that don't cause events. Returns
+        whether it became true before the timeout.
+        """
+        end_time = time.time() + timeout_sec
+        with self.data_lock:
+            events = self.domain_events(domain)
+            while True:
+                if predicate(events):
                     return True
                 remaining_time = end_time - time.time()
-        return False
+                if remaining_time <= 0:
+                    return False
+                # wait for a domain event or our timeout
+                events.condition.wait(min(remaining_time, recheck_sec or remaining_time))
+
+    # reboot flag should have probably been reset before this
+    # returns whether domain has rebooted
+    def wait_for_reboot(self, domain, timeout_sec=120):
+        return self.wait_for(domain, lambda events: events.rebooted, timeout_sec)
 
     def has_rebooted(self, domain):
-        key = (domain.name(), domain.ID())
         with self.data_lock:
-            return key in self.domain_has_rebooted
+            return self.domain_events(domain).rebooted
 
     def domain_is_running(self, domain):
-        key = (domain.name(), domain.ID())
         with self.data_lock:
-            return key in self.domain_status and self.domain_status[key]['status'] in ["Started", "Resumed"]
+            return self.domain_events(domain).is_running()
 
     def domain_is_stopped(self, domain):
-        key = (domain.name(), domain.ID())
         with self.data_lock:
-            return key in self.domain_status and self.domain_status[key] in [{'status': 'Shutdown', 'detail': 'Finished'},
-                                                                             {'status': 'Stopped', 'detail': 'Shutdown'}
-                                                                            ]
+            return self.domain_events(domain).is_stopped()
 
-    def wait_for_running(self, domain, timeout_sec=120):
-        start_time = time.time()
-        end_time = start_time + timeout_sec
-        if self.domain_is_running(domain):
-            return True
-        remaining_time = end_time - time.time()
-        with self.signal_condition:
-            while remaining_time > 0:
-                # wait for a domain event or our timeout
-                self.signal_condition.wait(remaining_time)
-                if self.domain_is_running(domain):
-                    return True
-                remaining_time = end_time - time.time()
-        return False
+    def wait_for_running(self, domain, timeout_sec=120, since=None):
+        """Wait for domain to run, or to have started or resumed after since"""
+        if since is None:
+            predicate = lambda events: events.is_running()
+        else:
+            predicate = lambda events: any(status in ["Started", "Resumed"] for (t, status, detail) in events.since(since))
+        return self.wait_for(domain, predicate, timeout_sec)
 
     def _domain_is_valid(self, uuid):
         try:
@@ -812,20 +1877,10 @@ class VirtEventHandler():
             return False
 
     def wait_for_stopped(self, domain, timeout_sec=120):
-        start_time = time.time()
-        end_time = start_time + timeout_sec
         uuid = domain.UUID()
-        if self.domain_is_stopped(domain) or not self._domain_is_valid(uuid):
-            return True
-        remaining_time = end_time - time.time()
-        with self.signal_condition:
-            while remaining_time > 0:
-                # wait for a domain event or our timeout
-                self.signal_condition.wait(remaining_time)
-                if self.domain_is_stopped(domain) or not self._domain_is_valid(uuid):
-                    return True
-                remaining_time = end_time - time.time()
-        return False
+        # a domain that goes away doesn't always tell us
+        return self.wait_for(domain, lambda events: events.is_stopped() or not self._domain_is_valid(uuid),
+                             timeout_sec, recheck_sec=1)
 
     def virEventLoopNativeStart(self):
         def virEventLoopNativeRun():
@@ -842,6 +1897,45 @@ class VirtEventHandler():
         self.eventLoopThread.setDaemon(True)
         self.eventLoopThread.start()
 
+def libvirt_connection(hypervisor, read_only=False):
+    tries_left = 5
+    connection = None
+    if read_only:
+        open_function = libvirt.openReadOnly
+    else:
+        open_function = libvirt.open
+    while not connection and (tries_left > 0):
+        try:
+            connection = open_function(hypervisor)
+        except:
+            # wait a bit
+            time.sleep(1)
+            pass
+        tries_left -= 1
+    if not connection:
+        # try again, but if an error occurs, don't catch it
+        connection = open_function(hypervisor)
+    return connection
+
+_virt_session = None
+
+def virt_session():
+    """Return the libvirt connection and VirtEventHandler of this process
+
+    All VirtMachines of a process share them. The handler only shows
+    events of domains that asked for it with allow_domain_debug_output().
+    """
+    global _virt_session
+    # Neither the connection nor the event loop thread survive a fork
+    if not _virt_session or _virt_session[0] != os.getpid():
+        # it is ESSENTIAL to register the default implementation of the event loop before opening a connection
+        # otherwise messages may be delayed or lost
+        libvirt.virEventRegisterDefaultImpl()
+        connection = libvirt_connection(hypervisor="qemu:///session")
+        event_handler = VirtEventHandler(libvirt_connection=connection, verbose=True)
+        _virt_session = (os.getpid(), connection, event_handler)
+    return _virt_session[1:]
+
 TEST_DOMAIN_XML="""
 <domain type='%(type)s'>
   <name>%(name)s</name>
@@ -852,6 +1946,7 @@ TEST_DOMAIN_XML="""
   </os>
   <memory unit='MiB'>%(memory_in_mib)d</memory>
   <currentMemory unit='MiB'>%(memory_in_mib)d</currentMemory>
+  %(memory_backing)s
   <features>
     <acpi/>
   </features>
@@ -869,8 +1964,10 @@ TEST_DOMAIN_XML="""
       %(mac)s
     </interface>
     <console type='pty'>
+      <log file='%(console_log)s' append='off'/>
       <target type='serial' port='0'/>
     </console>
+    %(balloon)s
     <disk type='file' device='cdrom'>
       <source file='%(iso)s'/>
       <target dev='hdb' bus='ide'/>
@@ -880,6 +1977,78 @@ TEST_DOMAIN_XML="""
 </domain>
 """
 
+# Memory options of TEST_DOMAIN_XML for the density modes
+DENSITY_BALLOON_XML = """<memballoon model='virtio' autodeflate='on'>
+      <stats period='5'/>
+    </memballoon>"""
+DENSITY_MEMORY_BACKING_XML = {
+    # qemu marks guest memory as mergeable for KSM, unless told otherwise
+    # with <nosharepages/>, but the host has to run KSM, see host_ksm_running()
+    "ksm": "",
+    # KSM doesn't merge huge pages, but they are cheaper to map
+    "hugepages": "<memoryBacking><hugepages/></memoryBacking>",
+}
+
+# How much memory the host should have left after starting a machine in density mode
+DENSITY_RESERVE_MB = 512
+
+# How long a started machine's memory might not show up as used yet
+DENSITY_SETTLE_SEC = 60
+
+# Prepared overlays of other revisions that weren't used for this long are removed
+PREPARED_MAX_AGE_SEC = 7 * 24 * 60 * 60
+
+def host_available_mb():
+    with open("/proc/meminfo", "r") as fp:
+        for line in fp:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) // 1024
+    return None
+
+def host_ksm_running():
+    """Check whether the kernel merges the pages that qemu marks as mergeable"""
+    try:
+        with open("/sys/kernel/mm/ksm/run", "r") as fp:
+            return fp.read().strip() == "1"
+    except IOError:
+        return False
+
+def admit_machine(run_dir, memory_mb, timeout_sec=300):
+    """Wait until the host has memory for another machine of memory_mb
+
+    This goes by the memory that the host has available, and not by how
+    much memory the running machines were given. Machines that started
+    during the last DENSITY_SETTLE_SEC, by any process, count with all of
+    their memory, as they may not have touched it yet.
+    """
+    lock = os.open(os.path.join(run_dir, "admission.lock"), os.O_RDWR | os.O_CREAT, 0640)
+    path = os.path.join(run_dir, "admission.json")
+    end_time = time.time() + timeout_sec
+    try:
+        while True:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(path, "r") as fp:
+                        starts = json.load(fp)
+                except (IOError, ValueError):
+                    starts = [ ]
+                now = time.time()
+                starts = [(t, mb) for (t, mb) in starts if now - t < DENSITY_SETTLE_SEC]
+                available = host_available_mb()
+                if available is None or available - sum(mb for (t, mb) in starts) - memory_mb >= DENSITY_RESERVE_MB:
+                    starts.append((now, memory_mb))
+                    with open(path, "w") as fp:
+                        json.dump(starts, fp)
+                    return
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            if now > end_time:
+                raise RepeatableFailure("Not enough memory on the host for another machine")
+            time.sleep(1)
+    finally:
+        os.close(lock)
+
 TEST_DISK_XML="""
 <disk type='file'>
   <driver name='qemu' type='raw'/>
@@ -894,6 +2063,15 @@ class VirtMachine(Machine):
     memory_mb = None
     cpus = None
 
+    # Start from an overlay with cockpit already configured, see _prepared_image()
+    prepared = os.environ.get("TEST_PREPARED", "") not in ("", "0")
+
+    # Run more machines per host: "ksm" or "hugepages", see DENSITY_MEMORY_BACKING_XML
+    density = os.environ.get("TEST_DENSITY", "")
+
+    # Random mac addresses, see reserve_macaddr()
+    _mac_slots = ResourceAllocator("macs", 0xffff)
+
     def __init__(self, image, **args):
 
         # The path to the image file to load, and parse an image name
@@ -911,14 +2089,11 @@ class VirtMachine(Machine):
         self.run_dir = os.path.join(os.environ.get("TEST_DATA", base_dir), "tmp", "run")
 
         self._network_description = etree.parse(open(os.path.join(LOCAL_DIR, "network-cockpit.xml")))
+        self._scratch_disks = ScratchDisks(os.path.join(self.run_dir, "disks"))
 
         self.test_disk_desc_original = None
 
-        # it is ESSENTIAL to register the default implementation of the event loop before opening a connection
-        # otherwise messages may be delayed or lost
-        libvirt.virEventRegisterDefaultImpl()
-        self.virt_connection = self._libvirt_connection(hypervisor = "qemu:///session")
-        self.event_handler = VirtEventHandler(libvirt_connection=self.virt_connection, verbose=self.verbose)
+        (self.virt_connection, self.event_handler) = virt_session()
 
         # network names are currently hardcoded into network-cockpit.xml
         self.network_name = "cockpit1"
@@ -929,64 +2104,38 @@ class VirtMachine(Machine):
         self._hostnet = 8
 
         self._domain = None
+        self._console_log = None
+        self._network_macs = None
+        self._reserved_macs = [ ]
+        self._restored = False
 
         # init variables needed for running a vm
         self._cleanup()
 
-    def _libvirt_connection(self, hypervisor, read_only = False):
-        tries_left = 5
-        connection = None
-        if read_only:
-            open_function = libvirt.openReadOnly
-        else:
-            open_function = libvirt.open
-        while not connection and (tries_left > 0):
-            try:
-                connection = open_function(hypervisor)
-            except:
-                # wait a bit
-                time.sleep(1)
-                pass
-            tries_left -= 1
-        if not connection:
-            # try again, but if an error occurs, don't catch it
-            connection = open_function(hypervisor)
-        return connection
-
-    def _resource_lockfile_path(self, resource):
-        resources = os.path.join(tempfile.gettempdir(), ".cockpit-test-resources")
-        resource = resource.replace("/", "_")
-        return os.path.join(resources, resource)
-
-    # The lock is open until the process calling this function exits
-    def _lock_resource(self, resource, exclusive=True):
-        resources = os.path.join(tempfile.gettempdir(), ".cockpit-test-resources")
-        if not os.path.exists(resources):
-            os.mkdir(resources, 0755)
-        lockpath = self._resource_lockfile_path(resource)
-        fd = os.open(lockpath, os.O_WRONLY | os.O_CREAT)
-        try:
-            flags = fcntl.LOCK_NB
-            if exclusive:
-                flags |= fcntl.LOCK_EX
-            else:
-                flags |= fcntl.LOCK_SH
-            fcntl.flock(fd, flags)
-        except IOError:
-            os.close(fd)
-            return False
-        else:
-            return True
-
     def reserve_macaddr(self):
-        pid = os.getpid()
-        for seed in range(1, 64 * 1024):
-            mac = "9E%02x%02x%02x%04x" % ((pid >> 16) & 0xff, (pid >> 8) & 0xff, pid & 0xff, seed)
-            mac = ":".join([mac[i:i+2] for i in range(0, len(mac), 2)])
-            if self._lock_resource(mac):
-                return mac
-
-        raise Failure("Couldn't find unused mac address for '%s'" % (self.image))
+        """Reserve a mac address for this machine until it is cleaned up"""
+        slot = VirtMachine._mac_slots.allocate()
+        self._reserved_macs.append(slot)
+        return self._slot_macaddr(slot)
+
+    def _slot_macaddr(self, slot):
+        return "9e:00:00:00:%02x:%02x" % (((slot + 1) >> 8) & 0xff, (slot + 1) & 0xff)
+
+    def _mac_slot(self, mac):
+        # The slot of a mac address from reserve_macaddr(), or None
+        if not mac or not mac.lower().startswith("9e:00:00:00:"):
+            return None
+        return int(mac[-5:].replace(":", ""), 16) - 1
+
+    def _claim_macaddr(self, mac):
+        # Reserve a given mac address, fails when another process has it
+        slot = self._mac_slot(mac)
+        if slot is None or slot in self._reserved_macs:
+            return True
+        if not VirtMachine._mac_slots.claim(slot):
+            return False
+        self._reserved_macs.append(slot)
+        return True
 
     def _choose_macaddr(self):
         # Check if this has a forced mac address
@@ -1010,11 +2159,16 @@ class VirtMachine(Machine):
                 raise
 
         image_to_use = self.image_file
+        self.cockpit_prepared = False
         if not maintain:
+            backing_file = self.image_file
+            if self.prepared and not self.atomic_image:
+                backing_file = self._prepared_image()
+                self.cockpit_prepared = True
             (unused, self._transient_image) = tempfile.mkstemp(suffix='.qcow2', prefix="", dir=self.run_dir)
             subprocess.check_call([ "qemu-img", "create", "-q",
                                     "-f", "qcow2",
-                                    "-o", "backing_file=%s" % self.image_file,
+                                    "-o", "backing_file=%s" % backing_file,
                                     self._transient_image ])
             image_to_use = self._transient_image
 
@@ -1046,21 +2200,41 @@ class VirtMachine(Machine):
             rand_extension = '-' + ''.join(random.choice(string.digits + string.ascii_lowercase) for i in range(4))
             domain_name = self.image + rand_extension
 
+        self._console_log = os.path.join(self.run_dir, "console-%s.log" % domain_name)
+        self._console_offset = 0
+        self._console_login = False
+        self._console_silent = False
+
+        memory_mb = memory_mb or VirtMachine.memory_mb or MEMORY_MB
+        memory_backing = balloon = ""
+        if self.density:
+            if self.density not in DENSITY_MEMORY_BACKING_XML:
+                raise Failure("Unknown density mode: " + self.density)
+            if self.density == "ksm" and not host_ksm_running():
+                raise Failure("TEST_DENSITY=ksm needs KSM running on the host, see /sys/kernel/mm/ksm/run")
+            memory_backing = DENSITY_MEMORY_BACKING_XML[self.density]
+            balloon = DENSITY_BALLOON_XML
+            admit_machine(self.run_dir, memory_mb)
+
         test_domain_desc = TEST_DOMAIN_XML % {
                                         "name": domain_name,
                                         "type": domain_type,
                                         "arch": self.arch,
                                         "cpu": cpu_desc,
-                                        "memory_in_mib": memory_mb or VirtMachine.memory_mb or MEMORY_MB,
+                                        "memory_in_mib": memory_mb,
+                                        "memory_backing": memory_backing,
+                                        "balloon": balloon,
                                         "drive": image_to_use,
                                         "mac": mac_desc,
-                                        "iso": os.path.join(LOCAL_DIR, "cloud-init.iso")
+                                        "iso": os.path.join(LOCAL_DIR, "cloud-init.iso"),
+                                        "console_log": self._console_log
                                       }
 
         # add the virtual machine
         try:
             # allow debug output for this domain
-            self.event_handler.allow_domain_debug_output(domain_name)
+            if self.verbose:
+                self.event_handler.allow_domain_debug_output(domain_name)
             self._domain = self.virt_connection.createXML(test_domain_desc, libvirt.VIR_DOMAIN_START_AUTODESTROY)
         except libvirt.libvirtError, le:
             # remove the debug output
@@ -1105,6 +2279,7 @@ class VirtMachine(Machine):
         finally:
             self._cleanup()
 
+    @timed("machine.start")
     def start(self, maintain=False, macaddr=None, memory_mb=None, cpus=None, wait_for_ip=True):
         if self.fetch and not os.path.exists(self.image_file):
             try:
@@ -1161,33 +2336,74 @@ class VirtMachine(Machine):
         expect.communicate(SCRIPT)
 
     def _ip_from_mac(self, mac, timeout_sec=300):
-        # Get address from the arp arp output looks like this.
-        #
-        # IP address     HW type  Flags  HW address         Mask  Device
-        # 10.111.118.45  0x1      0x0    9e:00:03:72:00:04  *     cockpit1
-        # ...
-
-        output = ""
-        start_time = time.time()
-        while (time.time() - start_time) < timeout_sec:
-            with open("/proc/net/arp", "r") as fp:
-                output = fp.read()
-            for line in output.split("\n"):
-                parts = re.split(' +', line)
-                if len(parts) > 5 and parts[3].lower() == mac.lower() and parts[5] == self.network_name:
-                    return parts[0]
-            time.sleep(1)
+        table = neighbours()
+        address = table.wait_for_address(mac, self.network_name, timeout_sec=timeout_sec)
+        if address:
+            return address
 
+        output = table.resync()
         message = "{0}: [{1}]\n{2}\n".format(mac, ", ".join(self._qemu_network_macs()), output)
         sys.stderr.write(message)
         self._diagnose_no_address()
         raise RepeatableFailure("Can't resolve IP of " + mac)
 
+    def _wait_console_login(self, timeout_sec=120):
+        """Wait for a login prompt on the serial console
+
+        The serial getty only starts after systemd-user-sessions, so once
+        the guest prints its prompt, logins are allowed. The console output
+        is written to our log file by libvirt as the guest prints it, and
+        only output since the last _skip_console_output() counts. Returns
+        False when no prompt shows up in time.
+        """
+        if not self._console_log:
+            return False
+        if self._console_login:
+            return True
+        pending = ""
+        end_time = time.time() + timeout_sec
+        while time.time() < end_time:
+            try:
+                with open(self._console_log, "r") as fp:
+                    fp.seek(self._console_offset)
+                    data = fp.read()
+            except IOError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                data = ""
+            self._console_offset += len(data)
+            pending = (pending + data)[-256:]
+            if " login: " in pending:
+                self._console_login = True
+                return True
+            if not data:
+                time.sleep(0.1)
+        return False
+
+    def _skip_console_output(self):
+        # Only look at console output from now on
+        self._console_login = False
+        self._console_silent = False
+        if self._console_log and os.path.exists(self._console_log):
+            self._console_offset = os.path.getsize(self._console_log)
+
+    def _wait_user_sessions(self, timeout_sec):
+        # Return as soon as the console shows that logins are allowed,
+        # instead of sleeping until the next try of wait_user_login().
+        # Without a prompt in time, the console is given up on for this
+        # boot, and the next tries are a second apart, as before.
+        if self._console_login or self._console_silent:
+            Machine._wait_user_sessions(self, min(timeout_sec, 1))
+        elif not self._wait_console_login(timeout_sec):
+            self._console_silent = True
+
     def reset_reboot_flag(self):
         self.event_handler.reset_domain_reboot_status(self._domain)
 
+    @timed("machine.wait_reboot")
     def wait_reboot(self, wait_for_running_timeout=120):
         self.disconnect()
+        self._skip_console_output()
         if not self.event_handler.wait_for_reboot(self._domain):
             raise Failure("system didn't notify us about a reboot")
         # we may have to check for a new dhcp lease, but the old one can be active for a bit
@@ -1195,6 +2411,7 @@ class VirtMachine(Machine):
             raise Failure("system didn't reboot properly")
         self.wait_user_login()
 
+    @timed("machine.wait_boot")
     def wait_boot(self, wait_for_running_timeout = 120, allow_one_reboot=False):
         # we should check for selinux relabeling in progress here
         if not self.event_handler.wait_for_running(self._domain, timeout_sec=wait_for_running_timeout ):
@@ -1219,6 +2436,7 @@ class VirtMachine(Machine):
                 self._diagnose_no_address()
                 raise Failure("Unable to reach machine %s via ssh." % (self.address))
             self.wait_user_login()
+            self._resync_restored()
         except:
             if allow_one_reboot:
                 self.wait_reboot()
@@ -1227,54 +2445,269 @@ class VirtMachine(Machine):
             else:
                 raise
 
+    def _snapshot_path(self, suffix):
+        return os.path.join(self.run_dir, "snapshot-%s.%s" % (os.path.basename(self.image_file), suffix))
+
+    @contextlib.contextmanager
+    def _run_dir_lock(self, name, exclusive=True):
+        try:
+            os.makedirs(self.run_dir, 0750)
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        fd = os.open(os.path.join(self.run_dir, name), os.O_WRONLY | os.O_CREAT, 0640)
+        try:
+            fcntl.flock(fd, exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(fd)
+
+    def _snapshot_lock(self, exclusive):
+        return self._run_dir_lock(os.path.basename(self._snapshot_path("lock")), exclusive)
+
+    def _image_stamp(self):
+        # A snapshot is only good for the image it was taken from
+        st = os.stat(self.image_file)
+        return "%s:%d:%d" % (os.path.realpath(self.image_file), st.st_size, int(st.st_mtime))
+
+    def _prepared_image(self):
+        """Return the prepared overlay of the image, and build it if necessary
+
+        A prepared overlay is the image after a boot with notls.conf for
+        cockpit.service already in place, see VirtMachine.prepared. It is
+        built once per image file and TEST_REVISION, and replaced when the
+        image file changes. Runs of other revisions keep their own overlays,
+        until they haven't been used for PREPARED_MAX_AGE_SEC.
+        """
+        name = "prepared-" + os.path.basename(self.image_file)
+        revision = hashlib.sha256(os.environ.get("TEST_REVISION", "")).hexdigest()[:8]
+        stamp = hashlib.sha256(self._image_stamp()).hexdigest()[:16]
+        path = os.path.join(self.run_dir, "%s-%s-%s.qcow2" % (name, revision, stamp))
+        with self._run_dir_lock(name + ".lock"):
+            if os.path.exists(path):
+                # The modification time says when it was last used
+                os.utime(path, None)
+                return path
+
+            self.message("Preparing", self.image)
+            builder = VirtMachine(image=self.image_file, verbose=self.verbose, fetch=self.fetch)
+            builder.prepared = False
+            overlay = None
+            try:
+                builder.start()
+                builder.wait_boot()
+                # Like the image setup scripts, don't leave the journal and the
+                # dhcp lease of this boot to the machines that start from here.
+                # journald keeps writing the rest of this boot to deleted files.
+                builder.execute(script=COCKPIT_NOTLS_SCRIPT + """ &&
+            rm -rf /var/log/journal/* /var/lib/NetworkManager/dhclient-*.lease &&
+            sync
+            """)
+                # Keep the overlay when the machine goes away, but only
+                # publish it once qemu surely doesn't write to it anymore
+                (overlay, builder._transient_image) = (builder._transient_image, None)
+                if not builder.shutdown():
+                    raise Failure("Machine for preparing {0} didn't power off".format(self.image))
+                for old in os.listdir(self.run_dir):
+                    match = re.match(re.escape(name) + r"-([0-9a-f]{8})-[0-9a-f]{16}\.qcow2$", old)
+                    if not match:
+                        continue
+                    old = os.path.join(self.run_dir, old)
+                    if match.group(1) == revision or time.time() - os.path.getmtime(old) > PREPARED_MAX_AGE_SEC:
+                        os.unlink(old)
+                os.rename(overlay, path)
+            except:
+                builder.kill()
+                if overlay and os.path.exists(overlay):
+                    os.unlink(overlay)
+                raise
+        return path
+
+    def _snapshot_metadata(self):
+        try:
+            with open(self._snapshot_path("json"), "r") as fp:
+                metadata = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if metadata.get("image") != self._image_stamp():
+            self.message("Ignoring outdated snapshot of", self.image)
+            return None
+        return metadata
+
+    def has_snapshot(self):
+        """Whether there is a snapshot of the current image to restore"""
+        with self._snapshot_lock(exclusive=False):
+            return self._snapshot_metadata() is not None
+
+    @timed("machine.save_snapshot")
+    def save_snapshot(self):
+        """Capture the running machine for restore_snapshot()
+
+        The memory state and the disk overlay of the machine are saved as
+        the snapshot of its image, replacing an older one. The machine then
+        continues from the snapshot, like a restored machine, so call
+        wait_boot() afterwards. Returns False when the machine has no
+        transient overlay to save.
+        """
+        if not self._domain or not self._transient_image:
+            return False
+        self.message("Saving snapshot of", self.image)
+        with self._snapshot_lock(exclusive=True):
+            self.disconnect()
+            metadata = { "address": self.address, "macaddr": self.macaddr, "image": self._image_stamp() }
+            self._domain.save(self._snapshot_path("state"))
+            self.event_handler.forbid_domain_debug_output(self._domain.name())
+            self.event_handler.forget_domain(self._domain)
+            self._domain = None
+            os.rename(self._transient_image, self._snapshot_path("qcow2"))
+            self._transient_image = None
+            with open(self._snapshot_path("json"), "w") as fp:
+                json.dump(metadata, fp)
+        if not self.restore_snapshot():
+            raise Failure("Couldn't restore the snapshot just saved of " + self.image)
+        return True
+
+    @timed("machine.restore_snapshot")
+    def restore_snapshot(self):
+        """Start the machine from the snapshot of its image
+
+        This takes seconds instead of a full boot. The machine gets a new
+        transient overlay on top of the saved disk, and comes back with
+        the address and mac of the machine the snapshot was taken from. So
+        only one restored machine of an image can run at a time, and this
+        returns False if another one is running, just like when there is
+        no usable snapshot. Call wait_boot() afterwards as usual.
+        """
+        with self._snapshot_lock(exclusive=False):
+            metadata = self._snapshot_metadata()
+            if not metadata:
+                return False
+            # Keep the mac of a snapshot that this machine just saved
+            self._cleanup(keep_macaddr=metadata["macaddr"])
+            if not self._claim_macaddr(metadata["macaddr"]):
+                self.message("Snapshot of", self.image, "is already running")
+                return False
+
+            (unused, self._transient_image) = tempfile.mkstemp(suffix='.qcow2', prefix="", dir=self.run_dir)
+            subprocess.check_call([ "qemu-img", "create", "-q",
+                                    "-f", "qcow2",
+                                    "-o", "backing_file=%s" % self._snapshot_path("qcow2"),
+                                    self._transient_image ])
+
+            # The saved domain needs a name of its own and the new overlay
+            state = self._snapshot_path("state")
+            desc = etree.fromstring(self.virt_connection.saveImageGetXMLDesc(state, 0))
+            rand_extension = '-' + ''.join(random.choice(string.digits + string.ascii_lowercase) for i in range(4))
+            domain_name = self.image + rand_extension
+            desc.find("name").text = domain_name
+            uuid = desc.find("uuid")
+            if uuid is not None:
+                desc.remove(uuid)
+            for disk in desc.findall("devices/disk"):
+                if disk.find("target").get("dev") == "vda":
+                    disk.find("source").set("file", self._transient_image)
+            self._console_log = os.path.join(self.run_dir, "console-%s.log" % domain_name)
+            self._console_offset = 0
+            self._console_login = False
+            self._console_silent = False
+            log = desc.find("devices/console/log")
+            if log is not None:
+                log.set("file", self._console_log)
+
+            try:
+                if self.verbose:
+                    self.event_handler.allow_domain_debug_output(domain_name)
+                self.virt_connection.restoreFlags(state, etree.tostring(desc), libvirt.VIR_DOMAIN_SAVE_RUNNING)
+                self._domain = self.virt_connection.lookupByName(domain_name)
+            except libvirt.libvirtError, le:
+                self.event_handler.forbid_domain_debug_output(domain_name)
+                self.message("Couldn't restore snapshot of", self.image, ":", le.message)
+                self._cleanup()
+                return False
+
+        self.macaddr = metadata["macaddr"]
+        self.address = metadata["address"]
+        self._maintaining = False
+        self._restored = True
+        return True
+
+    def _resync_restored(self):
+        # A restored machine continues with the clock and network of the
+        # moment its snapshot was saved
+        if not self._restored:
+            return
+        self._restored = False
+        self.execute("hwclock --hctosys || true; chronyc -a makestep >/dev/null 2>&1 || true", quiet=True)
+        addresses = self.execute("ip -4 -o addr show scope global", quiet=True)
+        if not re.search(r"\binet {0}/".format(re.escape(self.address)), addresses):
+            raise RepeatableFailure("Restored machine {0} lost its address {1}".format(self.image, self.address))
+
     def stop(self, timeout_sec=120):
         if self._maintaining:
             self.shutdown(timeout_sec=timeout_sec)
         else:
             self.kill()
 
-    def _cleanup(self, quick=False):
+    def _cleanup(self, quick=False, keep_macaddr=None, stopped=False):
         self.disconnect()
         try:
             if hasattr(self, '_disks'):
                 for index in dict(self._disks):
-                    self.rem_disk(index, quick)
+                    self.rem_disk(index, quick, stopped)
 
             self._disks = { }
 
             if self._domain:
                 # remove the debug output
                 self.event_handler.forbid_domain_debug_output(self._domain.name())
+                self.event_handler.forget_domain(self._domain)
 
             self._domain = None
+            self._network_macs = None
             self.address = None
             self.macaddr = None
+            self._restored = False
+            keep = self._mac_slot(keep_macaddr)
+            for slot in [s for s in self._reserved_macs if s != keep]:
+                self._reserved_macs.remove(slot)
+                VirtMachine._mac_slots.release(slot)
             if hasattr(self, '_transient_image') and self._transient_image and os.path.exists(self._transient_image):
                 os.unlink(self._transient_image)
+            if self._console_log and os.path.exists(self._console_log):
+                os.unlink(self._console_log)
+            self._console_log = None
         except:
             (type, value, traceback) = sys.exc_info()
             print >> sys.stderr, "WARNING: Cleanup failed:", str(value)
 
+    @timed("machine.kill")
     def kill(self):
         # stop system immediately, with potential data loss
         # to shutdown gracefully, use shutdown()
         self.disconnect()
+        stopped = True
         if self._domain:
             try:
                 # not graceful
                 with stdchannel_redirected(sys.stderr, os.devnull):
                     self._domain.destroyFlags(libvirt.VIR_DOMAIN_DESTROY_DEFAULT)
             except:
-                pass
-        self._cleanup(quick=True)
+                stopped = False
+        self._cleanup(quick=True, stopped=stopped)
 
     def wait_poweroff(self, timeout_sec=120):
-        # shutdown must have already been triggered
+        """Wait for a shutdown that has already been triggered
+
+        Returns whether the machine has surely stopped.
+        """
+        stopped = True
         if self._domain:
             if not self.event_handler.wait_for_stopped(self._domain, timeout_sec=timeout_sec):
                 self.message("waiting for machine poweroff timed out")
+                stopped = False
 
-        self._cleanup(quick=True)
+        self._cleanup(quick=True, stopped=stopped)
+        return stopped
 
     def shutdown(self, timeout_sec=120):
         # shutdown the system gracefully
@@ -1283,49 +2716,52 @@ class VirtMachine(Machine):
         try:
             if self._domain:
                 self._domain.shutdown()
-            self.wait_poweroff(timeout_sec=timeout_sec)
+            return self.wait_poweroff(timeout_sec=timeout_sec)
         finally:
             self._cleanup()
 
     def add_disk(self, size, serial=None):
-        index = 1
-        while index in self._disks:
-            index += 1
+        return self.add_disks([ size ], [ serial ])[0]
 
-        if not serial:
-            serial = "DISK%d" % index
-
-        try:
-            os.makedirs(self.run_dir, 0750)
-        except OSError, ex:
-            if ex.errno != errno.EEXIST:
-                raise
+    def add_disks(self, sizes, serials=None):
+        """Add several disks of the given sizes at once, and return their indexes
 
-        path = os.path.join(self.run_dir, "disk-%s-%d" % (self._domain.name(), index))
-        if os.path.exists(path):
-            os.unlink(path)
+        libvirt can't attach several devices in one call, so this
+        attaches them one by one, but saves the rest of the work.
+        """
+        indexes = [ ]
+        for (size, serial) in zip(sizes, serials or [ None ] * len(sizes)):
+            index = 1
+            while index in self._disks:
+                index += 1
 
-        subprocess.check_call(["qemu-img", "create", "-q", "-f", "raw", path, str(size)])
+            if not serial:
+                serial = "DISK%d" % index
 
-        dev = 'sd' + string.ascii_lowercase[index]
-        disk_desc = TEST_DISK_XML % {
-                          'file': path,
-                          'serial': serial,
-                          'unit': index,
-                          'dev': dev
-                        }
-
-        if self._domain.attachDeviceFlags(disk_desc, libvirt.VIR_DOMAIN_AFFECT_LIVE) != 0:
-            raise Failure("Unable to add disk to vm")
+            (path, slot) = self._scratch_disks.acquire(parse_size(size))
 
-        self._disks[index] = {
-            "path": path,
-            "serial": serial,
-            "filename": path,
-            "dev": dev
-        }
+            dev = 'sd' + string.ascii_lowercase[index]
+            disk_desc = TEST_DISK_XML % {
+                              'file': path,
+                              'serial': serial,
+                              'unit': index,
+                              'dev': dev
+                            }
+
+            if self._domain.attachDeviceFlags(disk_desc, libvirt.VIR_DOMAIN_AFFECT_LIVE) != 0:
+                self._scratch_disks.release(path, slot, in_use=True)
+                raise Failure("Unable to add disk to vm")
+
+            self._disks[index] = {
+                "path": path,
+                "slot": slot,
+                "serial": serial,
+                "filename": path,
+                "dev": dev
+            }
+            indexes.append(index)
 
-        return index
+        return indexes
 
     def set_disk_io_speed(self, disk_index, speed_in_bytes=0):
         subprocess.check_call([
@@ -1355,7 +2791,7 @@ class VirtMachine(Machine):
 
         return index
 
-    def rem_disk(self, index, quick=False):
+    def rem_disk(self, index, quick=False, stopped=False):
         assert index in self._disks
         disk = self._disks.pop(index)
 
@@ -1370,42 +2806,55 @@ class VirtMachine(Machine):
             if self._domain.detachDeviceFlags(disk_desc, libvirt.VIR_DOMAIN_AFFECT_LIVE ) != 0:
                 raise Failure("Unable to remove disk from vm")
 
-        # if this isn't just an additional path, clean up
-        if "path" in disk and disk["path"] and os.path.exists(disk["path"]):
-            os.unlink(disk["path"])
-
-    def _qemu_monitor(self, command):
-        self.message("& " + command)
+        # if this isn't just an additional path, give the image back, it
+        # can only be reused when qemu is surely gone: a live detach may not
+        # be finished in the guest yet, and a machine that didn't stop may
+        # still have the image open
+        if "slot" in disk:
+            self._scratch_disks.release(disk["path"], disk["slot"], in_use=not stopped)
+
+    def _qmp(self, command, **arguments):
+        """Run a QMP command in the qemu of the machine and return its result"""
+        request = json.dumps({ "execute": command, "arguments": arguments })
+        self.message("& " + request)
         # you can run commands manually using virsh:
-        # virsh -c qemu:///session qemu-monitor-command [domain name/id] --hmp [command]
-        output = libvirt_qemu.qemuMonitorCommand(self._domain, command, libvirt_qemu.VIR_DOMAIN_QEMU_MONITOR_COMMAND_HMP)
+        # virsh -c qemu:///session qemu-monitor-command [domain name/id] [json]
+        output = libvirt_qemu.qemuMonitorCommand(self._domain, request, 0)
         self.message(output.strip())
-        return output
+        try:
+            response = json.loads(output)
+        except ValueError:
+            raise Failure("Invalid QMP response to {0}: {1}".format(command, output))
+        if "error" in response:
+            raise Failure("QMP {0} failed: {1}".format(command, response["error"].get("desc", output)))
+        return response.get("return")
 
     def _qemu_network_macs(self):
-        macs = []
-        for line in self._qemu_monitor("info network").split("\n"):
-            x, y, mac = line.partition("macaddr=")
-            mac = mac.strip()
-            if mac:
-                macs.append(mac)
-        return macs
+        # The interfaces libvirt knows about, and the ones we added behind its back
+        if self._network_macs is None:
+            desc = etree.fromstring(self._domain.XMLDesc(0))
+            self._network_macs = [mac.get("address") for mac in desc.findall("devices/interface/mac")]
+        return list(self._network_macs)
 
     def add_netiface(self, mac=None, vlan=0):
         if not mac:
             mac = self.reserve_macaddr()
-        cmd = "device_add e1000,mac=%s" % mac
+        macs = self._qemu_network_macs()
+        device = { "driver": "e1000", "mac": mac }
         if vlan == 0:
             # selinux can prevent the creation of the bridge
             # https://bugzilla.redhat.com/show_bug.cgi?id=1267217
-            output = self._qemu_monitor("netdev_add bridge,id=hostnet%d,br=cockpit1" % self._hostnet)
-            if "Device 'bridge' could not be initialized" in output:
-                raise Failure("Unable to add bridge for virtual machine, possibly related to an selinux-denial")
-            cmd += ",netdev=hostnet%d" % self._hostnet
+            netdev = "hostnet%d" % self._hostnet
+            try:
+                self._qmp("netdev_add", type="bridge", id=netdev, br="cockpit1")
+            except Failure, ex:
+                raise Failure("Unable to add bridge for virtual machine, possibly related to an selinux-denial: " + str(ex))
+            device["netdev"] = netdev
             self._hostnet += 1
         else:
-            cmd += ",vlan=%d" % vlan
-        self._qemu_monitor(cmd)
+            device["vlan"] = vlan
+        self._qmp("device_add", **device)
+        self._network_macs = macs + [ mac ]
         return mac
 
     def needs_writable_usr(self):
@@ -1421,3 +2870,146 @@ done;
 """ % (address, port)
         with Timeout(seconds=seconds, error_message="Timeout while waiting for cockpit to start"):
             self.execute(script=WAIT_COCKPIT_RUNNING)
+
+class MachinePool:
+    """ Booted test machines of some images, ready to be leased
+
+        The pool keeps up to sizes[image] spare machines of each image
+        running, or default_size for images that are not listed, as long
+        as all spares together fit into memory_mb. A leased machine belongs
+        to the caller, who hands it back with release(). That destroys the
+        machine along with its transient overlay, and is never reused.
+
+        Spares are started without waiting for them, that only happens
+        when they are leased. So they boot while the caller is busy with
+        the machine it leased before.
+    """
+    def __init__(self, sizes=None, default_size=0, memory_mb=None, machine_class=None, verbose=False, fetch=True):
+        self.sizes = sizes or { }
+        self.default_size = default_size
+        self.memory_mb = memory_mb
+        self.machine_class = machine_class or VirtMachine
+        self.verbose = verbose
+        self.fetch = fetch
+        self.spares = { }
+        self.leases = 0
+        self.hits = 0
+        self.latencies = [ ]
+
+    @staticmethod
+    def parse_sizes(spec):
+        """Parse a "fedora-26=2,ipa=1" pool size spec
+
+        A plain number is the size for all images. Returns a tuple of
+        the sizes dictionary and the default size.
+        """
+        sizes = { }
+        default_size = 0
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            (image, sep, size) = item.rpartition("=")
+            try:
+                if sep:
+                    sizes[image] = int(size)
+                else:
+                    default_size = int(size)
+            except ValueError:
+                raise Failure("Invalid machine pool size: " + item)
+        return (sizes, default_size)
+
+    def message(self, *args):
+        if self.verbose:
+            print " ".join(args)
+
+    def size(self, image):
+        return self.sizes.get(image, self.default_size)
+
+    def _machine_memory(self):
+        return self.machine_class.memory_mb or MEMORY_MB
+
+    def _new_machine(self, image):
+        machine = self.machine_class(image=image, verbose=self.verbose, fetch=self.fetch, label="pool")
+        try:
+            machine.start(wait_for_ip=False)
+        except:
+            machine.kill()
+            raise
+        return machine
+
+    def fill(self, image):
+        """Start spare machines of image until the pool is full"""
+        spares = self.spares.setdefault(image, [ ])
+        while len(spares) < self.size(image):
+            if self.memory_mb is not None:
+                count = sum(map(len, self.spares.values()))
+                if (count + 1) * self._machine_memory() > self.memory_mb:
+                    break
+            try:
+                spares.append(self._new_machine(image))
+            except Failure, ex:
+                self.message("Couldn't start spare {0} machine: {1}".format(image, ex))
+                break
+            self.message("Started spare {0} machine".format(image))
+
+    @timed("machine.lease")
+    def lease(self, image, label=None):
+        """Return a booted machine of image, from the pool if possible"""
+        start = time.time()
+        machine = None
+        spares = self.spares.get(image, [ ])
+        while spares and not machine:
+            machine = spares.pop(0)
+            try:
+                machine.wait_boot()
+            except Failure, ex:
+                self.message("Discarding spare {0} machine: {1}".format(image, ex))
+                machine.kill()
+                machine = None
+
+        if machine:
+            self.hits += 1
+            self.fill(image)
+        else:
+            # Let the spares boot along with this machine
+            machine = self._new_machine(image)
+            self.fill(image)
+            try:
+                machine.wait_boot()
+            except:
+                machine.kill()
+                raise
+
+        if label:
+            machine.label = label
+        self.leases += 1
+        self.latencies.append(time.time() - start)
+        return machine
+
+    def release(self, machine):
+        machine.kill()
+
+    def close(self):
+        """Destroy all spare machines"""
+        for spares in self.spares.values():
+            while spares:
+                spares.pop().kill()
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "leases": self.leases,
+            "hits": self.hits,
+            "misses": self.leases - self.hits,
+            "hit_rate": float(self.hits) / self.leases if self.leases else 0.0,
+            "latency_mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+    def report(self):
+        stats = self.stats()
+        return ("machine pool: {leases} leases, {hits} hits, {misses} misses ({0:.0f}% hit rate), "
+                "lease latency mean {latency_mean:.1f}s, median {latency_p50:.1f}s, "
+                "max {latency_max:.1f}s").format(stats["hit_rate"] * 100, **stats)
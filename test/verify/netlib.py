@@ -18,6 +18,7 @@
 # along with Cockpit; If not, see <http://www.gnu.org/licenses/>.
 
 import subprocess
+import sys
 import re
 from testlib import *
 
@@ -30,23 +31,30 @@ class NetworkCase(MachineCase):
         # Ensure a clean and consistent state.  We remove rogue
         # connections that might still be here from the time of
         # creating the image and we prevent NM from automatically
-        # creating new connections.
-        # if the command fails, try again
+        # creating new connections.  All of this happens in a single
+        # round trip to the machine.
+        # if a command fails, try again
+        commands = [
+            "nmcli con show",
+            """nmcli -f UUID,DEVICE connection show | awk '$2 == "--" { print $1 }' | xargs -r nmcli con del""",
+            "printf '[main]\\nno-auto-default=*\\n' > /etc/NetworkManager/conf.d/99-test.conf",
+            "systemctl reload-or-restart NetworkManager",
+            "busctl --system get-property org.freedesktop.NetworkManager /org/freedesktop/NetworkManager org.freedesktop.NetworkManager Version || true"
+        ]
         failures_allowed = 3
         while True:
-            try:
-                print m.execute("nmcli con show")
-                m.execute("""nmcli -f UUID,DEVICE connection show | awk '$2 == "--" { print $1 }' | xargs -r nmcli con del""")
+            results = m.execute_many(commands)
+            failed = [ (command, result) for (command, result) in zip(commands, results) if result[0] != 0 ]
+            if not failed:
                 break
-            except subprocess.CalledProcessError:
-                failures_allowed -= 1
-                if failures_allowed == 0:
-                    raise
+            failures_allowed -= 1
+            if failures_allowed == 0:
+                (command, (code, output, error)) = failed[0]
+                sys.stderr.write(error)
+                raise subprocess.CalledProcessError(code, command, output=output)
 
-        m.write("/etc/NetworkManager/conf.d/99-test.conf", "[main]\nno-auto-default=*\n")
-        m.execute("systemctl reload-or-restart NetworkManager")
-
-        ver = self.machine.execute("busctl --system get-property org.freedesktop.NetworkManager /org/freedesktop/NetworkManager org.freedesktop.NetworkManager Version || true")
+        print results[0][1]
+        ver = results[4][1]
         m = re.match('s "(.*)"', ver)
         if m:
             self.networkmanager_version = map(int, m.group(1).split("."))
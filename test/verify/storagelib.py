@@ -20,6 +20,7 @@
 
 import os
 import re
+import subprocess
 from testlib import *
 
 class StorageCase(MachineCase):
@@ -29,12 +30,23 @@ class StorageCase(MachineCase):
             self.skipTest("No storage on Atomic")
 
         MachineCase.setUp(self)
-        self.storagectl_cmd = self.machine.execute("for cmd in storagedctl storagectl udisksctl; do if which $cmd 2>/dev/null; then break; fi; done").strip()
+
+        # Ask for both versions, so that it all happens in one round trip
+        commands = [
+            "for cmd in storagedctl storagectl udisksctl; do if which $cmd 2>/dev/null; then break; fi; done",
+            "busctl --system get-property org.freedesktop.UDisks2 /org/freedesktop/UDisks2/Manager org.freedesktop.UDisks2.Manager Version || true",
+            "busctl --system get-property org.storaged.Storaged /org/storaged/Storaged/Manager org.storaged.Storaged.Manager Version || true"
+        ]
+        results = self.machine.execute_many(commands)
+        for (command, (code, output, error)) in zip(commands, results):
+            if code != 0:
+                raise subprocess.CalledProcessError(code, command, output=output)
+        self.storagectl_cmd = results[0][1].strip()
 
         if "udisksctl" in self.storagectl_cmd:
-            ver = self.machine.execute("busctl --system get-property org.freedesktop.UDisks2 /org/freedesktop/UDisks2/Manager org.freedesktop.UDisks2.Manager Version || true")
+            ver = results[1][1]
         else:
-            ver = self.machine.execute("busctl --system get-property org.storaged.Storaged /org/storaged/Storaged/Manager org.storaged.Storaged.Manager Version || true")
+            ver = results[2][1]
         m = re.match('s "(.*)"', ver)
         if m:
             self.storaged_version = map(int, m.group(1).split("."))